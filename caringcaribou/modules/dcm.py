@@ -1,6 +1,6 @@
 from __future__ import print_function
 from caringcaribou.utils.can_actions import CanActions
-from caringcaribou.utils.common import parse_int_dec_or_hex
+from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex, periodic_counter
 from sys import stdout
 import argparse
 import time
@@ -70,6 +70,28 @@ NRC = {
     0x7F: "serviceNotSupportedInActiveSession"
 }
 
+# Byte-indexed lookup table for DCM_SERVICE_NAMES, with None for unknown service IDs
+DCM_SERVICE_NAMES_TBL = tuple(DCM_SERVICE_NAMES.get(i) for i in range(0x100))
+
+# Negative response codes indicating that a probed sub-function is not supported
+SUBFUNC_UNSUPPORTED_NRCS = frozenset([0x11, 0x12, 0x31])
+# Negative response code indicating that a response will follow later
+NRC_RESPONSE_PENDING = 0x78
+
+
+def get_service_name(service_id):
+    """
+    Returns the name of a DCM service
+
+    :param service_id: int service ID
+    :return: str service name, or "Unknown service" if the service ID is not known
+    """
+    if 0x00 <= service_id <= 0xFF:
+        service_name = DCM_SERVICE_NAMES_TBL[service_id]
+        if service_name is not None:
+            return service_name
+    return "Unknown service"
+
 
 def insert_message_length(data, pad=False):
     """
@@ -223,6 +245,15 @@ def dcm_discovery(args):
     class Diagnostics:
         found = False
 
+    def is_diagnostics_response(msg):
+        """
+        Returns a bool indicating whether 'msg' is a diagnostics response from a non-blacklisted arbitration ID
+
+        :param msg: can.Message instance to check
+        """
+        # Catch both ok and negative response
+        return msg.arbitration_id not in blacklist and len(msg.data) >= 2 and msg.data[1] in valid_responses
+
     with CanActions() as can_wrap:
         print("Starting diagnostics service discovery")
 
@@ -231,11 +262,7 @@ def dcm_discovery(args):
             stdout.flush()
 
             def response_analyser(msg):
-                # Ignore blacklisted arbitration IDs
-                if msg.arbitration_id in blacklist:
-                    return
-                # Catch both ok and negative response
-                if len(msg.data) >= 2 and msg.data[1] in valid_responses:
+                if is_diagnostics_response(msg):
                     Diagnostics.found = True
                     print("\nFound diagnostics at arbitration ID 0x{0:04x}, "
                           "reply at 0x{1:04x}".format(arb_id, msg.arbitration_id))
@@ -253,7 +280,8 @@ def dcm_discovery(args):
         # Message to bruteforce - [length, session control, default session]
         message = insert_message_length([0x10, 0x01], pad=True)
         can_wrap.bruteforce_arbitration_id(message, response_analyser_wrapper,
-                                           min_id=min_id, max_id=max_id, callback_end=discovery_finished)
+                                           min_id=min_id, max_id=max_id, callback_end=discovery_finished,
+                                           response_filter=is_diagnostics_response)
 
 
 def service_discovery(args):
@@ -301,7 +329,7 @@ def service_discovery(args):
             print("")
             # Print id and name of all found services
             for service in supported_services:
-                service_name = DCM_SERVICE_NAMES.get(service, "Unknown service")
+                service_name = get_service_name(service)
                 print("Supported service 0x{0:02x}: {1}".format(service, service_name))
 
 
@@ -332,19 +360,24 @@ def subfunc_discovery(args):
 
         def response_analyser_wrapper(data):
             print("\rProbing sub-function 0x{0:02x} data {1} (found: {2})".format(
-                service_id, data, len(found_sub_functions)), end="")
+                service_id, list_to_hex_str(data, " "), len(found_sub_functions)), end="")
             stdout.flush()
 
             def response_analyser(msg):
                 if msg.arbitration_id != rcv_arb_id:
                     return
-                # Response queued - do not handle
-                if msg.data[:4] == [0x03, 0x7f, service_id, 0x78]:
-                    can_wrap.current_delay = 1.0
-                    return
+                if msg.data[1] == 0x7F:
+                    if msg.data[3] == NRC_RESPONSE_PENDING:
+                        # Response queued - do not handle
+                        can_wrap.current_delay = 1.0
+                    elif msg.data[3] not in SUBFUNC_UNSUPPORTED_NRCS:
+                        # Negative response other than "not supported" - sub-function exists
+                        found_sub_functions.append((data, [msg]))
+                    else:
+                        # We got an answer - no reason to keep waiting
+                        can_wrap.current_delay = 0.0
                 # Catch ok status
-                elif msg.data[1] - 0x40 == service_id or \
-                        (msg.data[1] == 0x7F and msg.data[3] not in [0x11, 0x12, 0x31, 0x78]):
+                elif msg.data[1] - 0x40 == service_id:
                     found_sub_functions.append((data, [msg]))
                 elif msg.data[0] == 0x10:
                     # If response takes up multiple frames
@@ -383,9 +416,9 @@ def subfunc_discovery(args):
             # Print found functions
             if len(found_sub_functions) > 0:
                 print("\n\nFound sub-functions for service 0x{0:02x} ({1}):\n".format(
-                    service_id, DCM_SERVICE_NAMES.get(service_id, "Unknown service")))
+                    service_id, get_service_name(service_id)))
                 for (sub_function, msgs) in found_sub_functions:
-                    print("Sub-function {0}".format(" ".join(sub_function)))
+                    print("Sub-function {0}".format(list_to_hex_str(sub_function, " ")))
                     if show_data:
                         for message in msgs:
                             print("  {0}".format(message))
@@ -409,13 +442,10 @@ def tester_present(args):
     print("Sending TesterPresent to arbitration ID {0} (0x{0:02x})".format(send_arb_id))
     print("\nPress Ctrl+C to stop\n")
     with CanActions(arb_id=send_arb_id) as can_wrap:
-        counter = 1
-        while True:
+        for counter in periodic_counter(delay):
             can_wrap.send(data=message_data)
             print("\rCounter:", counter, end="")
             stdout.flush()
-            time.sleep(delay)
-            counter += 1
 
 
 def parse_args(args):
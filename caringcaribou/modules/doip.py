@@ -1,5 +1,5 @@
 from __future__ import print_function
-from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex
+from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex, periodic_counter
 from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED
 from caringcaribou.utils.constants import ARBITRATION_ID_MIN
 from caringcaribou.utils.iso14229_1 import Constants, NegativeResponseCodes
@@ -9,7 +9,6 @@ from udsoncan.client import Client
 from udsoncan.services import *
 from sys import stdout, version_info
 import argparse
-import datetime
 import time
 import sys
 import struct
@@ -395,8 +394,7 @@ def tester_present(arb_id_request, arb_id_response, delay, duration):
     auto_stop = duration is not None
     end_time = None
     if auto_stop:
-        end_time = (datetime.datetime.now()
-                    + datetime.timedelta(seconds=duration))
+        end_time = time.monotonic() + duration
 
     print("\nWaiting for Vehicle Identification Announcement\n")
     print("Power cycle your ECU and wait for a few seconds for the broadcast to be received\n")
@@ -407,18 +405,16 @@ def tester_present(arb_id_request, arb_id_response, delay, duration):
     doip_client = DoIPClient(ip, logical_address, client_logical_address=arb_id_response)
     conn = DoIPClientUDSConnector(doip_client)
     with Client(conn, request_timeout=5) as client:
-        counter = 1
         print("Sending TesterPresent to arbitration ID {0} (0x{0:02x})"
               .format(arb_id_request))
         print("\nPress Ctrl+C to stop\n")
-        while True:
+        for counter in periodic_counter(delay):
+            # The first message is always sent, even if the duration is zero
+            if counter > 1 and auto_stop and time.monotonic() >= end_time:
+                break
             client.tester_present()
             print("\rCounter:", counter, end="")
             stdout.flush()
-            time.sleep(delay)
-            counter += 1
-            if auto_stop and datetime.datetime.now() >= end_time:
-                break
 
 
 def __tester_present_wrapper(args):
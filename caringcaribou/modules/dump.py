@@ -1,47 +1,110 @@
 from __future__ import print_function
 from caringcaribou.utils.can_actions import CanActions
-from caringcaribou.utils.common import msg_to_candump_format, parse_int_dec_or_hex
+from caringcaribou.utils.common import list_to_hex_str, msg_to_candump_format, parse_int_dec_or_hex
 from caringcaribou.modules.send import FILE_LINE_COMMENT_PREFIX
 from sys import argv, stdout
+from functools import lru_cache
+from time import monotonic
 import argparse
 import datetime
+import queue
+import threading
 
+# Max number of seconds to block while waiting for incoming traffic before running separator handling
+IDLE_RECV_TIMEOUT = 0.1
+# Max number of lines waiting to be written to the output file
+WRITER_QUEUE_SIZE = 4096
+# Max number of lines to combine into a single write call
+WRITER_BATCH_SIZE = 64
+# Buffer size in bytes for the output file
+OUTPUT_FILE_BUFFER_SIZE = 1 << 20
+# Max number of seconds to block on a full writer queue before checking that the writer is still running
+WRITER_PUT_TIMEOUT = 0.5
+# Number of lines between each update of the progress counter
+WRITER_PROGRESS_INTERVAL = 256
+# Max number of distinct arbitration ID and data combinations to keep formatted candump strings for
+FORMAT_CACHE_SIZE = 4096
 
-def initiate_dump(handler, whitelist, separator_seconds, candump_format):
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def candump_id_and_data(arb_id, is_extended, data):
+    """
+    Returns the "ID#DATA" part of a candump format line. Results are cached, since periodic
+    CAN traffic tends to repeat the same arbitration ID and data over and over.
+
+    :param arb_id: int arbitration ID
+    :param is_extended: bool indicating whether 'arb_id' is an extended arbitration ID
+    :param data: bytes message data
+    :return: str on format "ID#DATA"
+    """
+    if is_extended:
+        output = "{0:08X}#{1}"
+    else:
+        output = "{0:03X}#{1}"
+    return output.format(arb_id, list_to_hex_str(bytearray(data), ""))
+
+
+def msg_to_candump_format_cached(msg):
+    """
+    Converts a CAN message to a string on candump format, using cached formatting of its arbitration ID and data
+
+    :param msg: message to convert
+    :type msg: can.Message
+    :return: candump format representation of 'msg'
+    :rtype str
+    """
+    id_and_data = candump_id_and_data(msg.arbitration_id, msg.is_extended_id, bytes(msg.data))
+    return "({0:.6f}) {1} {2}".format(msg.timestamp, msg.channel, id_and_data)
+
+
+def initiate_dump(handler, whitelist, separator_seconds, candump_format, format_cache=True):
     """
     Runs the 'handler' function on all incoming CAN messages.
 
-    Filtering is controlled by the list 'args.whitelist'
+    Filtering is controlled by the set 'args.whitelist'
     A separator is printed between messages if no messages have been handled in float 'args.separator_seconds'
 
     :param handler: function to call on all incoming messages
-    :param whitelist: list of allowed arbitration IDs, or None to allow all
+    :param whitelist: frozenset of allowed arbitration IDs, or None/empty to allow all
     :param separator_seconds: float seconds before printing a separator between messages, or None to never do this
     :param candump_format: bool indicating whether messages should be passed to 'handler' in candump str format
+    :param format_cache: bool indicating whether candump formatting of repeated messages should be cached
     """
 
-    if candump_format:
+    if candump_format and format_cache:
+        format_func = msg_to_candump_format_cached
+    elif candump_format:
         format_func = msg_to_candump_format
     else:
         format_func = str
     separator_enabled = separator_seconds is not None
-    last_message_timestamp = datetime.datetime.min
+    last_message_timestamp = 0.0
     messages_since_last_separator = 0
+    # Bind loop-invariant lookups to locals, since the loop below runs once per incoming message
+    allowed_ids = frozenset(whitelist or ())
+    now = monotonic
 
     print("Dumping CAN traffic (press Ctrl+C to exit)".format(whitelist))
     with CanActions(notifier_enabled=False) as can_wrap:
-        for msg in can_wrap.bus:
-            # Separator handling
-            if separator_enabled and messages_since_last_separator > 0:
-                if (datetime.datetime.now() - last_message_timestamp).total_seconds() > separator_seconds:
-                    # Print separator
-                    handler("--- Count: {0}".format(messages_since_last_separator))
-                    messages_since_last_separator = 0
-            # Message handling
-            if len(whitelist) == 0 or msg.arbitration_id in whitelist:
-                handler(format_func(msg))
-                last_message_timestamp = datetime.datetime.now()
-                messages_since_last_separator += 1
+        recv = can_wrap.bus.recv
+        while True:
+            # Drain all pending messages in one burst before doing any housekeeping
+            handled_in_burst = 0
+            msg = recv(IDLE_RECV_TIMEOUT)
+            while msg is not None:
+                if not allowed_ids or msg.arbitration_id in allowed_ids:
+                    handler(format_func(msg))
+                    handled_in_burst += 1
+                msg = recv(0)
+            # Separator handling - the clock only needs to be read once per burst
+            if handled_in_burst:
+                messages_since_last_separator += handled_in_burst
+                last_message_timestamp = now()
+            elif separator_enabled and messages_since_last_separator and \
+                    now() - last_message_timestamp > separator_seconds:
+                # Print separator
+                handler("--- Count: {0}".format(messages_since_last_separator))
+                messages_since_last_separator = 0
 
 
 def parse_args(args):
@@ -71,12 +134,18 @@ def parse_args(args):
                         action="store_true",
                         dest="candump_format",
                         help="Output on candump format")
+    parser.add_argument("-n", "--no-cache",
+                        action="store_false",
+                        dest="format_cache",
+                        help="Disable caching of formatted candump output (useful for traffic with few repeats)")
     parser.add_argument("-s",
                         type=float,
                         metavar="SEC",
                         dest="separator_seconds",
                         help="Print separating line after SEC silent seconds")
     args = parser.parse_args(args)
+    # Whitelist is checked against every incoming message, so use a set for constant time lookups
+    args.whitelist = frozenset(args.whitelist)
     return args
 
 
@@ -94,6 +163,47 @@ def file_header():
     return header
 
 
+def write_lines_to_file(line_queue, output_file, errors):
+    """
+    Writes lines from 'line_queue' to 'output_file' until a None value is received.
+
+    Lines are written in batches and progress is only printed every WRITER_PROGRESS_INTERVAL lines,
+    in order to keep file and terminal I/O off the CAN receive path.
+
+    :param line_queue: queue.Queue of str lines, terminated by None
+    :param output_file: file handle to write to
+    :param errors: list which an I/O error stopping the writer is appended to
+    """
+    try:
+        _write_lines_to_file(line_queue, output_file)
+    except IOError as e:
+        errors.append(e)
+
+
+def _write_lines_to_file(line_queue, output_file):
+    count = 0
+    next_progress_count = 0
+    done = False
+    while not done:
+        batch = [line_queue.get()]
+        # Coalesce any other lines which are already waiting
+        while len(batch) < WRITER_BATCH_SIZE:
+            try:
+                batch.append(line_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            batch = batch[:batch.index(None)]
+            done = True
+        if len(batch) > 0:
+            output_file.write("\n".join(batch) + "\n")
+            count += len(batch)
+        if count >= next_progress_count or done:
+            stdout.write("\rMessages printed to file: {0}".format(count))
+            stdout.flush()
+            next_progress_count = count + WRITER_PROGRESS_INTERVAL
+
+
 def module_main(args):
     """
     Dump module main wrapper.
@@ -104,28 +214,51 @@ def module_main(args):
     separator_seconds = args.separator_seconds
     candump_format = args.candump_format
     whitelist = args.whitelist
+    format_cache = args.format_cache
 
     # Print to stdout
     if args.file is None:
-        initiate_dump(print, whitelist, separator_seconds, candump_format)
+        initiate_dump(print, whitelist, separator_seconds, candump_format, format_cache)
     # Print to file
     else:
         try:
-            with open(args.file, "w") as output_file:
-                global count
-                count = 0
-
+            with open(args.file, "w", buffering=OUTPUT_FILE_BUFFER_SIZE) as output_file:
                 # Write file header
                 header = file_header()
                 output_file.write(header)
 
-                def write_line_to_file(line):
-                    global count
-                    count += 1
-                    print("\rMessages printed to file: {0}".format(count), end="")
-                    output_file.write("{0}\n".format(line))
-                    stdout.flush()
+                # Lines are written by a separate thread, so that file I/O does not delay reception of CAN messages
+                line_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+                writer_errors = []
+                writer = threading.Thread(target=write_lines_to_file, args=(line_queue, output_file, writer_errors))
+                writer.daemon = True
+                writer.start()
+
+                def put_line(line):
+                    # Only wait for queue space while the writer is running, to avoid blocking forever
+                    while True:
+                        try:
+                            line_queue.put(line, timeout=WRITER_PUT_TIMEOUT)
+                            return
+                        except queue.Full:
+                            if not writer.is_alive():
+                                raise writer_errors[0] if writer_errors else IOError("Output file writer stopped")
 
-                initiate_dump(write_line_to_file, whitelist, separator_seconds, candump_format)
+                try:
+                    initiate_dump(put_line, whitelist, separator_seconds, candump_format, format_cache)
+                except KeyboardInterrupt:
+                    # A writer error is reported below rather than hidden by the interrupt
+                    if not writer_errors:
+                        raise
+                finally:
+                    # Flush remaining lines to file before it is closed
+                    if writer.is_alive():
+                        try:
+                            put_line(None)
+                        except IOError:
+                            pass
+                        writer.join()
+                if writer_errors:
+                    raise writer_errors[0]
         except IOError as e:
             print("IOError: {0}".format(e))
@@ -5,7 +5,7 @@ import random
 from itertools import product
 from caringcaribou.utils.can_actions import CanActions
 from caringcaribou.utils.common import hex_str_to_nibble_list, int_from_byte_list, list_to_hex_str, parse_int_dec_or_hex
-from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MIN, BYTE_MAX, BYTE_MIN
+from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MIN
 from time import sleep
 
 
@@ -21,6 +21,8 @@ MIN_DATA_LENGTH = 1
 MAX_DATA_LENGTH = 8
 # Max size of random seed if no seed is provided in arguments
 DEFAULT_SEED_MAX = 2 ** 16
+# Number of random messages to generate randomness for at a time in 'random' mode
+RANDOM_BATCH_SIZE = 256
 # Number of sub-lists to split message list into per round in 'replay' mode
 REPLAY_NUMBER_OF_SUB_LISTS = 5
 
@@ -30,11 +32,10 @@ def directive_str(arb_id, data):
     Converts a directive to its string representation
 
     :param arb_id: message arbitration ID
-    :param data: message data bytes
+    :param data: bytes or bytearray of message data
     :return: str representing directive
     """
-    data = list_to_hex_str(data, "")
-    directive = "{0:03X}#{1}".format(arb_id, data)
+    directive = "{0:03X}#{1}".format(arb_id, data.hex())
     return directive
 
 
@@ -44,7 +45,7 @@ def write_directive_to_file_handle(file_handle, arb_id, data):
 
     :param file_handle: handle for the output file
     :param arb_id: int arbitration ID
-    :param data: list of data bytes
+    :param data: bytearray of data bytes
     """
     directive = directive_str(arb_id, data)
     file_handle.write("{0}\n".format(directive))
@@ -67,70 +68,80 @@ def parse_directive(directive):
     Parses a cansend directive
 
     :param directive: str representing a cansend directive
-    :return: tuple (int arbitration_id, [int data_byte])
+    :return: tuple (int arbitration_id, bytearray data)
     """
-    segments = directive.split("#")
-    arb_id = int(segments[0], 16)
-    data_str = segments[1]
-    data = [int(data_str[i:i + 2], 16) for i in range(0, len(data_str), 2)]
+    arb_id_str, separator, data_str = directive.partition("#")
+    if not separator:
+        raise ValueError("Missing '#' separator in directive: '{0}'".format(directive))
+    arb_id = int(arb_id_str, 16)
+    data = bytearray.fromhex(data_str)
     return arb_id, data
 
 
 def apply_fuzzed_data(initial_data, fuzzed_nibbles, bitmap):
     """
     Applies 'fuzzed_nibbles' on top of 'initial_data', for all indices where 'bitmap' is True.
-    Returns result as a list of bytes.
+    Returns result as a bytearray.
 
     Example:
     apply_fuzzed_data([0x2, 0x4, 0xA, 0xB], [0x5, 0xF], [False, True, True, False])
     gives the following result:
-    [0x25, 0xFB]
+    bytearray([0x25, 0xFB])
 
     :param initial_data: list of initial data nibbles
     :param fuzzed_nibbles: list of nibbles to apply
     :param bitmap: list of bool values, indicating where to apply fuzzed nibbles
-    :return: list of bytes
+    :return: bytearray of data bytes
     """
-    fuzz_index = 0
-    result_bytes = []
-    for index in range(0, len(bitmap), 2):
-        # Apply fuzzed nibbles on top of initial data
+    return fuzzed_data_applier(initial_data, bitmap)(fuzzed_nibbles)
+
+
+def fuzzed_data_applier(initial_data, bitmap):
+    """
+    Returns a function which applies fuzzed nibbles on top of 'initial_data', as apply_fuzzed_data does
+    for a fixed 'initial_data' and 'bitmap'. Fuzzed indices without a corresponding fuzzed nibble are zero.
+
+    The nibbles which are not fuzzed are packed into an int once, so that each call only needs to
+    shift the fuzzed nibbles into place. Use this when many sets of nibbles are applied to the same data.
+
+    :param initial_data: list of initial data nibbles
+    :param bitmap: list of bool values, indicating where to apply fuzzed nibbles
+    :return: function taking a list of fuzzed nibbles and returning a bytearray of data bytes
+    """
+    # A trailing odd nibble does not form a full byte and is dropped, as in nibbles_to_bytes
+    byte_count = min(len(initial_data), len(bitmap)) // 2
+    nibble_count = 2 * byte_count
+    static_value = 0
+    fuzzed_shifts = []
+    for index in range(nibble_count):
+        shift = 4 * (nibble_count - 1 - index)
         if bitmap[index]:
-            high_nibble = fuzzed_nibbles[fuzz_index]
-            fuzz_index += 1
+            fuzzed_shifts.append(shift)
         else:
-            high_nibble = initial_data[index]
+            static_value |= (initial_data[index] or 0x0) << shift
 
-        if bitmap[index + 1]:
-            low_nibble = fuzzed_nibbles[fuzz_index]
-            fuzz_index += 1
-        else:
-            low_nibble = initial_data[index + 1]
+    def apply(fuzzed_nibbles):
+        value = static_value
+        for shift, nibble in zip(fuzzed_shifts, fuzzed_nibbles):
+            value |= nibble << shift
+        return bytearray(value.to_bytes(byte_count, "big"))
 
-        current_byte = (high_nibble << 4) + low_nibble
-        result_bytes.append(current_byte)
-    return result_bytes
+    return apply
 
 
 def nibbles_to_bytes(nibbles):
     """
-    Converts a list of nibbles into a list of corresponding bytes.
+    Converts a list of nibbles into a bytearray of corresponding bytes.
 
     Example:
     nibbles_to_bytes([0x2, 0x1, 0xF, 0xA, 0x3, 0xC])
     gives
-    [0x21, 0xFA, 0x3C]
+    bytearray([0x21, 0xFA, 0x3C])
 
     :param nibbles: list of nibble values
-    :return: list of int values (bytes)
+    :return: bytearray of data bytes
     """
-    result_bytes = []
-    for index in range(0, len(nibbles), 2):
-        high_nibble = nibbles[index]
-        low_nibble = nibbles[index + 1]
-        current_byte = (high_nibble << 4) + low_nibble
-        result_bytes.append(current_byte)
-    return result_bytes
+    return bytearray((high_nibble << 4) | low_nibble for high_nibble, low_nibble in zip(nibbles[0::2], nibbles[1::2]))
 
 
 def split_lists(full_list, pieces):
@@ -142,42 +153,40 @@ def split_lists(full_list, pieces):
     :return: yields one sub-list at a time
     """
     length = len(full_list)
-    for i in range(pieces):
-        sub_list = full_list[i * length // pieces: (i + 1) * length // pieces]
+    bounds = [i * length // pieces for i in range(pieces + 1)]
+    for start, end in zip(bounds, bounds[1:]):
+        sub_list = full_list[start:end]
         if len(sub_list) == 0:
             # Skip empty sub-lists (e.g. if a list of 2 elements is split into 3 parts, one will be empty)
             continue
         yield sub_list
 
 
-def get_random_arbitration_id(min_id, max_id):
+def random_message_generator(min_id, max_id, min_length, max_length, batch_size=RANDOM_BATCH_SIZE):
     """
-    Returns a random arbitration ID in the range min_id <= arb_id <= max_id
+    Generator for random messages, whose arbitration IDs lie in the interval 'min_id' to 'max_id' and
+    data lengths lie in the interval 'min_length' to 'max_length'.
+
+    Randomness is drawn for 'batch_size' messages at a time, in order to keep PRNG calls out of the send loop.
 
     :param min_id: int minimum allowed arbitration ID (inclusive)
     :param max_id: int maximum allowed arbitration ID (inclusive)
-    :return: int arbitration ID
-    """
-    arb_id = random.randint(min_id, max_id)
-    return arb_id
-
-
-def get_random_data(min_length, max_length):
-    """
-    Generates a list of random data bytes, whose length lies in the interval 'min_length' to 'max_length'
-
-    :param min_length: int minimum length
-    :param max_length: int maximum length
-    :return: list of randomized bytes
-    """
-    # Decide number of bytes to generate
-    data_length = random.randint(min_length, max_length)
-    # Generate random bytes
-    data = []
-    for i in range(data_length):
-        data_byte = random.randint(BYTE_MIN, BYTE_MAX)
-        data.append(data_byte)
-    return data
+    :param min_length: int minimum data length
+    :param max_length: int maximum data length
+    :param batch_size: int number of messages to generate randomness for at a time
+    :return: generator of (int arbitration ID, bytearray data) tuples
+    """
+    id_range = range(min_id, max_id + 1)
+    length_range = range(min_length, max_length + 1)
+    pool_size = batch_size * max_length
+    while True:
+        arb_ids = random.choices(id_range, k=batch_size)
+        lengths = random.choices(length_range, k=batch_size)
+        pool = random.getrandbits(8 * pool_size).to_bytes(pool_size, "little") if pool_size > 0 else b""
+        offset = 0
+        for arb_id, data_length in zip(arb_ids, lengths):
+            yield arb_id, bytearray(pool[offset:offset + data_length])
+            offset += max_length
 
 
 def parse_directives_from_file(filename):
@@ -190,16 +199,17 @@ def parse_directives_from_file(filename):
     print("Parsing messages from {0}".format(filename))
     line_number = 0
     with open(filename, "r") as fd:
-        directives = []
-        for directive in fd:
-            line_number += 1
-            directive = directive.rstrip()
-            if directive:
-                try:
-                    composite = parse_directive(directive)
-                    directives.append(composite)
-                except ValueError:
-                    print("  Error: Could not parse message on line {0}: {1}".format(line_number, directive))
+        lines = fd.read().splitlines()
+    directives = []
+    for directive in lines:
+        line_number += 1
+        directive = directive.rstrip()
+        if directive:
+            try:
+                composite = parse_directive(directive)
+                directives.append(composite)
+            except ValueError:
+                print("  Error: Could not parse message on line {0}: {1}".format(line_number, directive))
     print("  {0} messages parsed".format(len(directives)))
     return directives
 
@@ -228,7 +238,7 @@ def random_fuzz(static_arb_id=None, static_data=None, filename=None, min_id=ARBI
     A simple random fuzzer algorithm, which sends random or static data to random or static arbitration IDs
 
     :param static_arb_id: int representing static arbitration ID
-    :param static_data: list of bytes representing static data
+    :param static_data: bytearray representing static data
     :param filename: file to write cansend directives to
     :param min_id: minimum allowed arbitration ID
     :param max_id: maximum allowed arbitration ID
@@ -252,12 +262,15 @@ def random_fuzz(static_arb_id=None, static_data=None, filename=None, min_id=ARBI
     if not 0 <= start_index:
         raise ValueError("Invalid start index '{0}', must be 0 or larger".format(start_index))
 
+    if static_data is not None:
+        static_data = bytearray(static_data)
+
     # Seed handling
     set_seed(seed)
 
     # Define a callback function which will handle incoming messages
     def response_handler(msg):
-        if msg.arbitration_id != arb_id or list(msg.data) != data:
+        if msg.arbitration_id != arb_id or msg.data != data:
             directive = directive_str(arb_id, data)
             print("\rDirective: {0} (index {1})".format(directive, current_index))
             print("  Received message: {0}".format(msg))
@@ -277,19 +290,11 @@ def random_fuzz(static_arb_id=None, static_data=None, filename=None, min_id=ARBI
             if show_status:
                 print("Starting at index {0}\n".format(start_index))
             # Fuzzing logic
-            while True:
-                # Set arbitration ID
-                if static_arb_id is None:
-                    # Use a random arbitration ID
-                    arb_id = get_random_arbitration_id(min_id, max_id)
-                else:
-                    # Use the static arbitration ID
+            for arb_id, data in random_message_generator(min_id, max_id, min_data_length, max_data_length):
+                # Use static arbitration ID and/or data if set
+                if static_arb_id is not None:
                     arb_id = static_arb_id
-
-                # Set data
-                if static_data is None:
-                    data = get_random_data(min_data_length, max_data_length)
-                else:
+                if static_data is not None:
                     data = static_data
 
                 # If start index is not reached yet, continue without sending and sleeping
@@ -362,7 +367,7 @@ def bruteforce_fuzz(arb_id, initial_data, data_bitmap, filename=None, start_inde
 
     def response_handler(msg):
         # Callback handler for printing incoming messages
-        if msg.arbitration_id != arb_id or list(msg.data) != output_data:
+        if msg.arbitration_id != arb_id or msg.data != output_data:
             response_directive = directive_str(msg.arbitration_id, msg.data)
             print("  Received {0}".format(response_directive))
 
@@ -372,7 +377,8 @@ def bruteforce_fuzz(arb_id, initial_data, data_bitmap, filename=None, start_inde
 
     file_logging_enabled = filename is not None
     output_file = None
-    output_data = []
+    output_data = bytearray()
+    apply_fuzzed_nibbles = fuzzed_data_applier(initial_data, data_bitmap)
     try:
         if file_logging_enabled:
             output_file = open(filename, "a")
@@ -389,7 +395,7 @@ def bruteforce_fuzz(arb_id, initial_data, data_bitmap, filename=None, start_inde
                     message_count += 1
                     continue
                 # Apply fuzzed data
-                output_data = apply_fuzzed_data(initial_data, current_fuzzed_nibbles, data_bitmap)
+                output_data = apply_fuzzed_nibbles(current_fuzzed_nibbles)
                 # Send message
                 can_wrap.send(output_data)
                 message_count += 1
@@ -434,7 +440,7 @@ def mutate_fuzz(initial_arb_id, initial_data, arb_id_bitmap, data_bitmap, filena
 
     def response_handler(msg):
         # Callback handler for printing incoming messages
-        if msg.arbitration_id != arb_id or list(msg.data) != data:
+        if msg.arbitration_id != arb_id or msg.data != data:
             response_directive = directive_str(msg.arbitration_id, msg.data)
             print("  Received {0}".format(response_directive))
 
@@ -451,6 +457,8 @@ def mutate_fuzz(initial_arb_id, initial_data, arb_id_bitmap, data_bitmap, filena
         data = apply_fuzzed_data(initial_data, [], data_bitmap)
     if number_of_nibbles_to_fuzz_arb_id == 0:
         arb_id = int_from_byte_list(apply_fuzzed_data(initial_arb_id, [], arb_id_bitmap))
+    apply_fuzzed_arb_id = fuzzed_data_applier(initial_arb_id, arb_id_bitmap)
+    apply_fuzzed_data_nibbles = fuzzed_data_applier(initial_data, data_bitmap)
 
     try:
         if file_logging_enabled:
@@ -464,13 +472,13 @@ def mutate_fuzz(initial_arb_id, initial_data, arb_id_bitmap, data_bitmap, filena
                 if number_of_nibbles_to_fuzz_arb_id > 0:
                     # Mutate arbitration ID
                     fuzzed_nibbles_arb_id = [random.randint(0, 0xF) for _ in range(number_of_nibbles_to_fuzz_arb_id)]
-                    arb_id_bytes = apply_fuzzed_data(initial_arb_id, fuzzed_nibbles_arb_id, arb_id_bitmap)
+                    arb_id_bytes = apply_fuzzed_arb_id(fuzzed_nibbles_arb_id)
                     arb_id = int_from_byte_list(arb_id_bytes)
 
                 if number_of_nibbles_to_fuzz_data > 0:
                     # Mutate data
                     fuzzed_nibbles_data = [random.randint(0, 0xF) for _ in range(number_of_nibbles_to_fuzz_data)]
-                    data = apply_fuzzed_data(initial_data, fuzzed_nibbles_data, data_bitmap)
+                    data = apply_fuzzed_data_nibbles(fuzzed_nibbles_data)
 
                 if current_index < start_index:
                     current_index += 1
@@ -498,14 +506,14 @@ def replay_fuzz(directives, show_requests, show_responses):
     """
     Replay cansend directives from 'filename'
 
-    :param directives: list of (int arb_id, list data) tuples
+    :param directives: list of (int arb_id, bytearray data) tuples
     :param show_requests: bool indicating whether requests should be printed to stdout
     :param show_responses: bool indicating whether responses should be printed to stdout
     """
 
     # Define a callback function which will handle incoming messages
     def response_handler(msg):
-        if msg.arbitration_id != arb_id or list(msg.data) != data:
+        if msg.arbitration_id != arb_id or msg.data != data:
             if not show_requests:
                 # Print last sent request
                 print("Sent: {0}".format(directive))
@@ -540,7 +548,7 @@ def identify_fuzz(all_composites, show_responses):
     """
 
     def response_handler(msg):
-        if msg.arbitration_id != arb_id or list(msg.data) != data:
+        if msg.arbitration_id != arb_id or msg.data != data:
             response_directive = directive_str(msg.arbitration_id, msg.data)
             print("  Received {0}".format(response_directive))
 
@@ -1,37 +1,68 @@
 from caringcaribou.utils.can_actions import CanActions
-from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex, str_to_int_list
+from caringcaribou.utils.common import hex_str_to_bytes, list_to_hex_str, wait_until
 from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED
-from time import sleep
-from sys import exit
+from itertools import cycle
+from time import monotonic, sleep
+from sys import exit, stdout
 import argparse
+import can
+import mmap
+import os
+import queue
 import re
+import threading
 
 
 FILE_LINE_COMMENT_PREFIX = "#"
 PADDING_BYTE = 0x00
+PADDING = bytes([PADDING_BYTE])
+# Max number of parsed messages waiting to be sent when sending from file
+STREAM_QUEUE_SIZE = 4096
+# Full candump log file contents, matched one line at a time - each match is a message, a comment or a blank line
+CANDUMP_FILE_REGEX = re.compile(br"^(?:\((?P<timestamp>\d+\.\d+)\)[ \t]+\S+[ \t]+"
+                                br"(?P<arb_id>[0-9a-fA-F]+)#(?P<data>[0-9a-fA-F]*)|" +
+                                re.escape(FILE_LINE_COMMENT_PREFIX.encode()) + br".*|)[ \t\r]*(?:\n|\Z)",
+                                re.MULTILINE)
+# Line format of python-can log files (which differs between versions)
+# Only the fields which are used are captured, and trailing fields (such as channel) are not matched at all
+PYTHONCAN_LINE_REGEX = re.compile(r"Timestamp: +(?P<timestamp>\d+\.\d+) +ID: (?P<arb_id>[0-9a-fA-F]{1,8}) +"
+                                  r"(?:\d+|(?P<is_extended>[SX]) (?P<is_error>[E ]) (?P<is_remote>[R ])) +"
+                                  r"DLC: +[0-8] +(?P<data>(?:[0-9a-fA-F]{2} ?){0,8})")
 
 
 class CanMessage:
     """
     Message wrapper class used by file parsers.
     """
+    # Avoid a per-instance __dict__, since large log files are parsed into a lot of instances
+    __slots__ = ("arb_id", "data", "delay", "is_extended", "is_error", "is_remote", "_log_line")
 
     def __init__(self, arb_id, data, delay, is_extended=None, is_error=False, is_remote=False):
         """
         :param arb_id: int - arbitration ID
-        :param data: list of ints - data bytes
+        :param data: bytes - data bytes
         :param delay: float - delay in seconds
         """
         self.arb_id = arb_id
         self.data = data
         # Negative delays are not allowed
-        self.delay = max([delay, 0.0])
-        if is_extended is None:
-            self.is_extended = arb_id > ARBITRATION_ID_MAX
-        else:
-            self.is_extended = is_extended
+        self.delay = delay if delay > 0.0 else 0.0
+        self.is_extended = arb_id > ARBITRATION_ID_MAX if is_extended is None else is_extended
         self.is_error = is_error
         self.is_remote = is_remote
+        self._log_line = None
+
+    @property
+    def log_line(self):
+        """
+        Line printed when the message is sent. It is rendered on first use and reused after that,
+        e.g. when a message sequence is looped.
+
+        :return: str log line, including trailing newline
+        """
+        if self._log_line is None:
+            self._log_line = "  Arb_id: 0x{0:08x}, data: {1}\n".format(self.arb_id, list_to_hex_str(self.data, "."))
+        return self._log_line
 
 
 def parse_messages(msgs, delay, pad):
@@ -43,37 +74,41 @@ def parse_messages(msgs, delay, pad):
     :param pad: bool indicating whether messages should be padded to 8 bytes
     :return: list of CanMessage instances
     """
-    message_list = []
+    message_list = [None] * len(msgs)
+    position = 0
     msg = None
     try:
-        for msg in msgs:
-            msg_parts = msg.split("#", 1)
+        for position, msg in enumerate(msgs):
+            arb_id_str, separator, data_str = msg.partition("#")
+            if not separator:
+                raise ValueError("Missing '#' between arbitration ID and data")
             # Check arbitration ID
-            arb_id = parse_int_dec_or_hex(msg_parts[0])
-            if arb_id is None:
-                raise ValueError("Invalid arbitration ID: '{0}'".format(msg_parts[0]))
+            try:
+                # Base 0 parses hex with "0x" prefix and decimal otherwise
+                arb_id = int(arb_id_str, 0)
+            except ValueError:
+                raise ValueError("Invalid arbitration ID: '{0}'".format(arb_id_str))
+            if arb_id < 0:
+                raise ValueError("Invalid arbitration ID: '{0}'".format(arb_id_str))
             if arb_id > ARBITRATION_ID_MAX_EXTENDED:
                 raise ValueError("Arbitration ID too large (max is 0x{0:x})".format(ARBITRATION_ID_MAX_EXTENDED))
             # Check data length
-            byte_list = msg_parts[1].split(".")
+            byte_list = data_str.split(".")
             if not 0 < len(byte_list) <= 8:
                 raise ValueError("Invalid data length: {0}".format(len(byte_list)))
             # Validate data bytes
-            msg_data = []
-            for byte in byte_list:
-                byte_int = int(byte, 16)
+            byte_values = [int(byte, 16) for byte in byte_list]
+            for byte, byte_int in zip(byte_list, byte_values):
                 if not 0x00 <= byte_int <= 0xff:
                     raise ValueError("Invalid byte value: '{0}'".format(byte))
-                msg_data.append(byte_int)
+            msg_data = bytes(byte_values)
             if pad:
                 # Pad to 8 bytes
-                msg_data.extend([PADDING_BYTE] * (8 - len(msg_data)))
-            fixed_msg = CanMessage(arb_id, msg_data, delay)
-            message_list.append(fixed_msg)
-        # No delay before sending first message
+                msg_data = msg_data.ljust(8, PADDING)
+            message_list[position] = CanMessage(arb_id, msg_data, delay)
         return message_list
     except ValueError as e:
-        print("Invalid message at position {0}: '{1}'\nFailure reason: {2}".format(len(message_list), msg, e))
+        print("Invalid message at position {0}: '{1}'\nFailure reason: {2}".format(position, msg, e))
         exit()
 
 
@@ -91,7 +126,7 @@ def parse_candump_line(curr_line, prev_timestamp, force_delay):
     time_stamp = float(segments[0][1:-1])
     msg_segs = segments[2].split("#")
     arb_id = int(msg_segs[0], 16)
-    data = str_to_int_list(msg_segs[1])
+    data = hex_str_to_bytes(msg_segs[1])
     if prev_timestamp is None:
         delay = 0
     elif force_delay is not None:
@@ -111,13 +146,10 @@ def parse_pythoncan_line(curr_line, prev_timestamp, force_delay):
     :param force_delay: float value to override delay or None to use calculated delay
     :return: CanMessage representing 'curr_line', datetime.datetime timestamp of 'curr_line'
     """
-    line_regex = re.compile(r"Timestamp: +(?P<timestamp>\d+\.\d+) +ID: (?P<arb_id>[0-9a-fA-F]+) +"
-                            r"((\d+)|(?P<is_extended>[SX]) (?P<is_error>[E ]) (?P<is_remote>[R ])) +"
-                            r"DLC: +[0-8] +(?P<data>(?:[0-9a-fA-F]{2} ?){0,8}) *(Channel: (?P<channel>\w*))?")
-    parsed_msg = line_regex.match(curr_line)
+    parsed_msg = PYTHONCAN_LINE_REGEX.match(curr_line)
     arb_id = int(parsed_msg.group("arb_id"), 16)
     time_stamp = float(parsed_msg.group("timestamp"))
-    data = list(int(a, 16) for a in parsed_msg.group("data").split(" ") if a)
+    data = bytes.fromhex(parsed_msg.group("data"))
     if prev_timestamp is None:
         delay = 0
     elif force_delay is not None:
@@ -132,6 +164,76 @@ def parse_pythoncan_line(curr_line, prev_timestamp, force_delay):
     return message, time_stamp
 
 
+def iter_parse_file(filename, force_delay):
+    """
+    Generator for messages parsed from a file containing CAN traffic logs.
+
+    Candump files are parsed with a single regex pass over a memory map of the file, without first copying
+    it into a str. From the first line which does not match (or for other formats), parsing continues
+    line by line, which also gives detailed errors for lines which can not be parsed.
+
+    :param filename: Path to file
+    :param force_delay: Delay value between each message (if omitted, the delays specified by log file are used)
+    :return: generator of CanMessage instances
+    :raises IOError: if the file could not be read or parsed
+    """
+    timestamp = None
+    line_parser = None
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            position = 0
+            # Fast path for candump files
+            if contents[:1] in (b"(", FILE_LINE_COMMENT_PREFIX.encode()):
+                for match in CANDUMP_FILE_REGEX.finditer(contents):
+                    # Any gap between matches is a line which needs to be parsed line by line
+                    if match.start() != position:
+                        break
+                    position = match.end()
+                    timestamp_str = match.group("timestamp")
+                    if timestamp_str is None:
+                        # Comment or blank line
+                        continue
+                    line_parser = parse_candump_line
+                    if force_delay is None:
+                        time_stamp = float(timestamp_str)
+                        if timestamp is None:
+                            delay = 0
+                        else:
+                            delay = time_stamp - timestamp
+                        timestamp = time_stamp
+                    elif timestamp is None:
+                        # Timestamps are not needed when delay is forced - only whether this is the first message
+                        delay = 0
+                        timestamp = 0.0
+                    else:
+                        delay = force_delay
+                    data = hex_str_to_bytes(match.group("data"))
+                    yield CanMessage(int(match.group("arb_id"), 16), data, delay)
+        # Continue line by line from the first line which was not handled above, reading lazily from the file
+        f.seek(position)
+        for raw_line in f:
+            line = raw_line.decode("utf-8", "replace")
+            # Skip comments and blank lines
+            if line.startswith(FILE_LINE_COMMENT_PREFIX) or len(line.strip()) == 0:
+                continue
+            # First non-comment line - identify log format
+            if line_parser is None:
+                if line.startswith("("):
+                    line_parser = parse_candump_line
+                elif line.startswith("Timestamp"):
+                    line_parser = parse_pythoncan_line
+                else:
+                    raise IOError("Unrecognized file type - could not parse file")
+            # Parse line
+            try:
+                msg, timestamp = line_parser(line, timestamp, force_delay)
+            except (ValueError, AttributeError) as e:
+                raise IOError("Could not parse line:\n  '{0}'\n  Reason: {1}".format(line.rstrip("\n"), e))
+            yield msg
+
+
 def parse_file(filename, force_delay):
     """
     Parses a file containing CAN traffic logs.
@@ -140,55 +242,128 @@ def parse_file(filename, force_delay):
     :param force_delay: Delay value between each message (if omitted, the delays specified by log file are used)
     :return: list of CanMessage instances
     """
-
     try:
-        messages = []
-        with open(filename, "r") as f:
-            timestamp = None
-            line_parser = None
-            for line in f:
-                # Skip comments and blank lines
-                if line.startswith(FILE_LINE_COMMENT_PREFIX) or len(line.strip()) == 0:
-                    continue
-                # First non-comment line - identify log format
-                if line_parser is None:
-                    if line.startswith("("):
-                        line_parser = parse_candump_line
-                    elif line.startswith("Timestamp"):
-                        line_parser = parse_pythoncan_line
-                    else:
-                        raise IOError("Unrecognized file type - could not parse file")
-                # Parse line
-                try:
-                    msg, timestamp = line_parser(line, timestamp, force_delay)
-                except (ValueError, AttributeError) as e:
-                    raise IOError("Could not parse line:\n  '{0}'\n  Reason: {1}".format(line.rstrip("\n"), e))
-                messages.append(msg)
-            return messages
+        return list(iter_parse_file(filename, force_delay))
     except IOError as e:
         print("ERROR: {0}\n".format(e))
         return None
 
 
-def send_messages(messages, loop):
+def stream_file_messages(filename, force_delay):
+    """
+    Generator for messages parsed from 'filename' by a separate thread, so that sending can start
+    before the whole file has been parsed. At most STREAM_QUEUE_SIZE parsed messages are kept in memory.
+
+    :param filename: Path to file
+    :param force_delay: Delay value between each message (if omitted, the delays specified by log file are used)
+    :return: generator of CanMessage instances
+    :raises IOError: if the file could not be read or parsed
+    """
+    message_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def parse_to_queue():
+        try:
+            for message in iter_parse_file(filename, force_delay):
+                message_queue.put(message)
+            message_queue.put(None)
+        except IOError as e:
+            message_queue.put(e)
+
+    parser_thread = threading.Thread(target=parse_to_queue)
+    parser_thread.daemon = True
+    parser_thread.start()
+    while True:
+        item = message_queue.get()
+        if item is None:
+            return
+        if isinstance(item, IOError):
+            raise item
+        yield item
+
+
+def send_messages(messages, loop, show_messages=True, busy_wait=True):
     """
     Sends a list of messages separated by a given delay.
 
+    Send times are scheduled from the time of the first message, so that time spent printing and sending
+    does not add up over the sequence.
+
     :param loop: bool indicating whether the message sequence should be looped (re-sent over and over)
-    :param messages: List of messages, where a message has the format (arb_id, [data_byte])
+    :param messages: List of CanMessage instances, or any iterable of them if 'loop' is False
+    :param show_messages: bool indicating whether each sent message should be printed
+    :param busy_wait: bool indicating whether the last part of each delay should be busy-waited for better accuracy
+    :return: int number of messages sent
     """
+    if loop:
+        message_sequence = cycle(messages)
+    else:
+        message_sequence = iter(messages)
+    write = stdout.write
+    now = monotonic
     with CanActions(notifier_enabled=False) as can_wrap:
-        loop_counter = 0
+        if loop and send_messages_periodically(can_wrap.bus, messages, show_messages):
+            return len(messages)
+        send = can_wrap.send
+        send_time = None
+        messages_sent = 0
+        try:
+            for msg in message_sequence:
+                # No delay before sending first message
+                if send_time is None:
+                    send_time = now()
+                else:
+                    send_time += msg.delay
+                    if busy_wait:
+                        wait_until(send_time)
+                    else:
+                        remaining = send_time - now()
+                        if remaining > 0:
+                            sleep(remaining)
+                if show_messages:
+                    write(msg.log_line)
+                send(msg.data, msg.arb_id, msg.is_extended, msg.is_error, msg.is_remote)
+                messages_sent += 1
+        finally:
+            stdout.flush()
+    return messages_sent
+
+
+def send_messages_periodically(bus, messages, show_messages=True):
+    """
+    Sends a looped message sequence through the periodic send support of 'bus', which lets the bus
+    (e.g. the SocketCAN broadcast manager) pace the messages instead of Python. Blocks until interrupted.
+
+    This is only possible when all messages share the same arbitration ID and a single, non-zero delay.
+
+    :param bus: can.BusABC to send on
+    :param messages: List of CanMessage instances
+    :param show_messages: bool indicating whether the message sequence should be printed
+    :return: bool indicating whether periodic sending was possible - if False, nothing has been sent
+    """
+    period = messages[0].delay
+    if period <= 0.0:
+        return False
+    if any(msg.arb_id != messages[0].arb_id or msg.delay != period for msg in messages):
+        return False
+    can_messages = [can.Message(arbitration_id=msg.arb_id,
+                                data=msg.data,
+                                is_extended_id=msg.is_extended,
+                                is_error_frame=msg.is_error,
+                                is_remote_frame=msg.is_remote) for msg in messages]
+    try:
+        task = bus.send_periodic(can_messages, period)
+    except (NotImplementedError, TypeError, ValueError, can.CanError):
+        # Bus or python-can version does not support periodic sending of this sequence
+        return False
+    try:
+        if show_messages:
+            for msg in messages:
+                stdout.write(msg.log_line)
+        print("Sending sequence every {0} seconds (press Ctrl+C to exit)".format(period * len(messages)))
         while True:
-            for i in range(len(messages)):
-                msg = messages[i]
-                if i != 0 or loop_counter != 0:
-                    sleep(msg.delay)
-                print("  Arb_id: 0x{0:08x}, data: {1}".format(msg.arb_id, list_to_hex_str(msg.data, ".")))
-                can_wrap.send(msg.data, msg.arb_id, msg.is_extended, msg.is_error, msg.is_remote)
-            if not loop:
-                break
-            loop_counter += 1
+            sleep(1)
+    finally:
+        task.stop()
 
 
 def __handle_parse_messages(args):
@@ -248,6 +423,9 @@ def parse_args(args):
     cmd_msgs.add_argument("--delay", "-d", metavar="D", type=float, default=0,
                           help="delay between messages in seconds")
     cmd_msgs.add_argument("--loop", "-l", action="store_true", help="loop message sequence (re-send over and over)")
+    cmd_msgs.add_argument("--quiet", "-q", action="store_true", help="do not print each message as it is sent")
+    cmd_msgs.add_argument("--no-busywait", dest="busy_wait", action="store_false",
+                            help="only sleep between messages (less accurate timing, but lower CPU usage)")
     cmd_msgs.add_argument("--pad", "-p", action="store_true", help="automatically pad messages to 8 bytes length")
     cmd_msgs.set_defaults(func=__handle_parse_messages)
 
@@ -257,6 +435,9 @@ def parse_args(args):
     file_msg.add_argument("--delay", "-d", metavar="D", type=float, default=None,
                           help="delay between messages in seconds (overrides timestamps in file)")
     file_msg.add_argument("--loop", "-l", action="store_true", help="loop message sequence (re-send over and over)")
+    file_msg.add_argument("--quiet", "-q", action="store_true", help="do not print each message as it is sent")
+    file_msg.add_argument("--no-busywait", dest="busy_wait", action="store_false",
+                            help="only sleep between messages (less accurate timing, but lower CPU usage)")
     file_msg.set_defaults(func=__handle_parse_file)
 
     args = parser.parse_args(args)
@@ -270,6 +451,20 @@ def module_main(args):
     :param args: List of module arguments
     """
     args = parse_args(args)
+    if args.module_function == "file" and not args.loop:
+        # Send messages while the file is being parsed - looping needs the full list of messages first
+        print("Sending messages from {0}".format(args.filename))
+        try:
+            messages_sent = send_messages(stream_file_messages(args.filename, args.delay), False,
+                                          not args.quiet, args.busy_wait)
+        except IOError as e:
+            print("ERROR: {0}\n".format(e))
+            return
+        if messages_sent == 0:
+            print("No messages parsed")
+        else:
+            print("  {0} messages sent".format(messages_sent))
+        return
     print("Parsing messages")
     messages = args.func(args)
     if not messages:
@@ -277,4 +472,4 @@ def module_main(args):
     else:
         print("  {0} messages parsed".format(len(messages)))
         print("Sending messages")
-        send_messages(messages, args.loop)
+        send_messages(messages, args.loop, not args.quiet, args.busy_wait)
@@ -1,13 +1,12 @@
 from __future__ import print_function
 from caringcaribou.utils.can_actions import auto_blacklist
-from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex
+from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex, periodic_counter
 from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED
 from caringcaribou.utils.constants import ARBITRATION_ID_MIN
 from caringcaribou.utils.iso15765_2 import IsoTp
 from caringcaribou.utils.iso14229_1 import Constants, Iso14229_1, NegativeResponseCodes, Services, ServiceID
 from sys import stdout, version_info
 import argparse
-import datetime
 import time
 
 # Handle large ranges efficiently in both python 2 and 3
@@ -190,9 +189,9 @@ def uds_discovery(min_id, max_id, blacklist_args, auto_blacklist_duration,
                 stdout.flush()
             # Send Diagnostic Session Control
             tp.transmit(sess_ctrl_frm, send_arb_id, None)
-            end_time = time.time() + delay
+            end_time = time.monotonic() + delay
             # Listen for response
-            while time.time() < end_time:
+            while time.monotonic() < end_time:
                 msg = tp.bus.recv(0)
                 if msg is None:
                     # No response received
@@ -224,10 +223,10 @@ def uds_discovery(min_id, max_id, blacklist_args, auto_blacklist_duration,
                                         None)
                             # Give some extra time for verification, in
                             # case of slow responses
-                            verification_end_time = (time.time()
+                            verification_end_time = (time.monotonic()
                                                      + delay
                                                      + VERIFICATION_EXTRA_DELAY)
-                            while time.time() < verification_end_time:
+                            while time.monotonic() < verification_end_time:
                                 verification_msg = tp.bus.recv(0)
                                 if verification_msg is None:
                                     continue
@@ -518,8 +517,7 @@ def tester_present(arb_id_request, delay, duration,
     auto_stop = duration is not None
     end_time = None
     if auto_stop:
-        end_time = (datetime.datetime.now()
-                    + datetime.timedelta(seconds=duration))
+        end_time = time.monotonic() + duration
 
     service_id = Services.TesterPresent.service_id
     message_data = [service_id, sub_function]
@@ -527,15 +525,13 @@ def tester_present(arb_id_request, delay, duration,
           .format(arb_id_request))
     print("\nPress Ctrl+C to stop\n")
     with IsoTp(arb_id_request, None) as can_wrap:
-        counter = 1
-        while True:
+        for counter in periodic_counter(delay):
+            # The first message is always sent, even if the duration is zero
+            if counter > 1 and auto_stop and time.monotonic() >= end_time:
+                break
             can_wrap.send_request(message_data)
             print("\rCounter:", counter, end="")
             stdout.flush()
-            time.sleep(delay)
-            counter += 1
-            if auto_stop and datetime.datetime.now() >= end_time:
-                break
 
 
 def __tester_present_wrapper(args):
@@ -1,11 +1,20 @@
 from __future__ import print_function
 from caringcaribou.utils.can_actions import CanActions, auto_blacklist
 from caringcaribou.utils.common import list_to_hex_str, parse_int_dec_or_hex
-from datetime import datetime, timedelta
+from collections import namedtuple
 from sys import stdout
 import argparse
+import struct
+import threading
 import time
 
+# Number of seconds to wait for a reply before timing out
+REPLY_TIMEOUT = 3.0
+# Maximum number of seconds to wait for the reply to an XCP info probe
+PROBE_TIMEOUT = 2.0
+# Minimum number of seconds between discovery and dump progress updates
+PROGRESS_INTERVAL = 0.05
+
 # Dictionary of XCP error codes
 XCP_ERROR_CODES = {
     0x00: ("ERR_CMD_SYNC", "Command processor synchronisation."),
@@ -28,8 +37,8 @@ XCP_ERROR_CODES = {
     0x32: ("ERR_VERIFY", "The slave internal program verify routine detects an error.")
 }
 
-# List of XCP Command codes
-XCP_COMMAND_CODES = [
+# Tuple of XCP Command codes
+XCP_COMMAND_CODES = (
     (0xFF, "CONNECT"),
     (0xFE, "DISCONNECT"),
     (0xFD, "GET_STATUS"),
@@ -86,7 +95,123 @@ XCP_COMMAND_CODES = [
     (0xCA, "PROGRAM_NEXT"),
     (0xC9, "PROGRAM_MAX"),
     (0xC8, "PROGRAM_VERIFY")
-]
+)
+
+# XCP CONNECT command in normal mode
+XCP_CONNECT_MESSAGE = bytes(bytearray([0xff, 0, 0, 0, 0, 0, 0, 0]))
+
+# Probe message data and the callback handling its reply
+ProbeMessage = namedtuple("ProbeMessage", ["message_data", "callback"])
+
+# Masks for the bits of a byte, least significant bit first
+BIT_MASKS = tuple(1 << i for i in range(8))
+
+# Bit names (least significant bit first) of the bit fields in XCP responses
+RESOURCE_BITS = ("CAL/PAG", "X (bit 1)", "DAQ", "STIM", "PGM", "X (bit 5)", "X (bit 6)", "X (bit 7)")
+COMM_MODE_BASIC_BITS = ("BYTE_ORDER", "ADDRESS_GRANULARITY_0", "ADDRESS_GRANULARITY_1", "X (bit 3)",
+                        "X (bit 4)", "X (bit 5)", "SLAVE_BLOCK_MODE", "OPTIONAL")
+COMM_MODE_OPTIONAL_BITS = ("MASTER_BLOCK_MODE", "INTERLEAVED_MODE", "X (bit 2)", "X (bit 3)",
+                           "X (bit 4)", "X (bit 5)", "X (bit 6)", "X (bit 7)")
+CURRENT_SESSION_STATUS_BITS = ("STORE_CAL_REQ", "X (bit 1)", "STORE_DAQ_REQ", "CLEAR_DAQ_REQ",
+                               "X (bit 4)", "X (bit 5)", "DAQ_RUNNING", "RESUME")
+
+
+class DiscoveryState:
+    """
+    State shared between the callbacks of an XCP arbitration ID discovery.
+    """
+    __slots__ = ("hit_counter", "last_progress_time")
+
+    def __init__(self):
+        self.hit_counter = 0
+        self.last_progress_time = 0.0
+
+
+class DumpState:
+    """
+    State shared between the reply handlers of an XCP memory dump.
+    """
+    __slots__ = ("byte_counter", "bytes_left", "dump_complete", "last_progress_time", "max_segment_size",
+                 "segment_counter")
+
+    def __init__(self, length):
+        """
+        :param length: int - number of bytes to dump
+        """
+        # Counters for data length
+        self.byte_counter = 0
+        self.bytes_left = length
+        self.segment_counter = 0
+        self.dump_complete = False
+        self.last_progress_time = 0.0
+        # Bytes per UPLOAD request (updated to MAX_CTO - 1 from the connect reply)
+        self.max_segment_size = 0x7
+
+
+def print_bit_flags(value, bit_names, line_format):
+    """
+    Prints the state of each bit in 'value', one line per bit.
+
+    :param value: The bit field value
+    :param bit_names: Names of the bits, least significant bit first
+    :param line_format: Format string for each line, taking the bit name and the bit state as a bool
+    """
+    for bit_name, bit_mask in zip(bit_names, BIT_MASKS):
+        print(line_format.format(bit_name, bool(value & bit_mask)))
+
+
+def get_address_granularity(comm_mode_basic):
+    """
+    Returns the address granularity encoded in bits 1-2 of a COMM_MODE_BASIC byte.
+
+    :param comm_mode_basic: The COMM_MODE_BASIC byte of a connect response
+    :return: Number of bytes per address (1, 2, 4 or 8)
+    """
+    return 1 << ((comm_mode_basic >> 1) & 0x3)
+
+
+def get_byte_order(comm_mode_basic):
+    """
+    Returns the struct byte order character for the BYTE_ORDER bit of a COMM_MODE_BASIC byte.
+
+    :param comm_mode_basic: The COMM_MODE_BASIC byte of a connect response
+    :return: ">" for Motorola format (MSB first), "<" for Intel format (LSB first)
+    """
+    return ">" if comm_mode_basic & 1 else "<"
+
+
+def get_session_configuration_id(data, byte_order="<"):
+    """
+    Returns the session configuration ID (bytes 4-5) of a GET_STATUS response.
+
+    :param data: The GET_STATUS response data
+    :param byte_order: struct byte order character of the slave, as returned by get_byte_order
+    :return: int session configuration ID
+    """
+    return struct.unpack(byte_order + "H", bytes(data[4:6]))[0]
+
+
+def xcp_reply(expected_arb_id):
+    """
+    Decorator for XCP reply handlers. The decorated handler is only called for
+    positive replies (0xff) from 'expected_arb_id', while error replies (0xfe) are decoded and printed.
+
+    :param expected_arb_id: Arbitration ID of the XCP slave's replies
+    :return: A decorator wrapping a reply handler
+    """
+    def decorator(handler):
+        def wrapper(msg):
+            if msg.arbitration_id != expected_arb_id:
+                return
+            pid = msg.data[0]
+            if pid == 0xff:
+                handler(msg)
+            elif pid == 0xfe:
+                decode_xcp_error(msg)
+            else:
+                print("Unexpected reply: {0}\n".format(msg))
+        return wrapper
+    return decorator
 
 
 def decode_xcp_error(error_message):
@@ -118,16 +243,11 @@ def decode_connect_response(response_message):
         return
     print("-" * 20)
     print("Resource protection status\n")  # Note: sometimes referred to as RESSOURCE (sic) in specification
-    resource_bits = ["CAL/PAG", "X (bit 1)", "DAQ", "STIM", "PGM", "X (bit 5)", "X (bit 6)", "X (bit 7)"]
-    for i in range(8):
-        print("{0:<12}{1}".format(resource_bits[i], bool(data[1] & 2 ** i)))
+    print_bit_flags(data[1], RESOURCE_BITS, "{0:<12}{1}")
     print("-" * 20)
     print("COMM_MODE_BASIC\n")
-    comm_mode_bits = ["BYTE_ORDER", "ADDRESS_GRANULARITY_0", "ADDRESS_GRANULARITY_1", "X (bit 3)",
-                      "X (bit 4)", "X (bit 5)", "SLAVE_BLOCK_MODE", "OPTIONAL"]
-    for i in range(8):
-        print("{0:<24}{1}".format(comm_mode_bits[i], int(bool(data[2] & 2 ** i))))
-    print("\nAddress granularity: {0} byte(s) per address".format(2 ** ((data[2] & 4) * 2 + data[2] & 2)))
+    print_bit_flags(data[2], COMM_MODE_BASIC_BITS, "{0:<24}{1:d}")
+    print("\nAddress granularity: {0} byte(s) per address".format(get_address_granularity(data[2])))
     print("-" * 20)
     print("Max CTO message length: {0} bytes".format(data[3]))
     print("Max DTO message length: {0} bytes".format(data[5] * 16 + data[4]))
@@ -147,9 +267,7 @@ def decode_get_comm_mode_info_response(response_message):
     print("Reserved: 0x{0:02x}".format(data[1]))
     print("-" * 20)
     print("COMM_MODE_OPTIONAL")
-    comm_mode_optional_bits = ["MASTER_BLOCK_MODE", "INTERLEAVED_MODE"] + ["X (bit {0})".format(i) for i in range(2, 8)]
-    for i in range(8):
-        print("{0:<20}{1}".format(comm_mode_optional_bits[i], bool(data[2] & 2 ** i)))
+    print_bit_flags(data[2], COMM_MODE_OPTIONAL_BITS, "{0:<20}{1}")
     print("-" * 20)
     print("Reserved: 0x{0:02x}".format(data[3]))
     print("MAX_BS (master block mode): {0} command packets".format(data[4]))
@@ -158,34 +276,34 @@ def decode_get_comm_mode_info_response(response_message):
     print("XCP Driver version: 0x{0:02x}".format(data[7]))
 
 
-def decode_get_status_response(response_message):
+def decode_get_status_response(response_message, byte_order="<"):
+    """
+    Decodes an XCP GET_STATUS response and prints the response information.
+
+    :param response_message: The response message
+    :param byte_order: struct byte order character of the slave, as returned by get_byte_order
+    """
     print("> DECODE GET STATUS")
     print(response_message)
     data = response_message.data
     print("-" * 20)
     print("CURRENT_SESSION_STATUS")
-    current_session_status_bits = ["STORE_CAL_REQ", "X (bit 1)", "STORE_DAQ_REQ", "CLEAR_DAQ_REQ",
-                                   "X (bit 4)", "X (bit 5)", "DAQ_RUNNING", "RESUME"]
-    for i in range(8):
-        print("{0:<16}{1}".format(current_session_status_bits[i], int(bool(data[1] & 2 ** i))))
+    print_bit_flags(data[1], CURRENT_SESSION_STATUS_BITS, "{0:<16}{1:d}")
     print("-" * 20)
     print("RESOURCE PROTECTION STATUS | Seed/key required")
-    resource_protection_bits = ["CAL/PAG", "X (bit 1)", "DAQ", "STIM", "PGM", "X (bit 5)", "X (bit 6)", "X (bit 7)"]
-    for i in range(8):
-        print("{0:<27}| {1}".format(resource_protection_bits[i], bool(data[2] & 2 ** i)))
+    print_bit_flags(data[2], RESOURCE_BITS, "{0:<27}| {1}")
     print("-" * 20)
     print("Reserved: 0x{0:02x}".format(data[3]))
-    print("Session configuration ID: {0}".format(2 ** ((data[5] & 4) * 2 + data[4] & 2)))
+    print("Session configuration ID: {0}".format(get_session_configuration_id(data, byte_order)))
 
 
 def xcp_arbitration_id_discovery(args):
     """Scans for XCP support by brute forcing XCP connect messages against different arbitration IDs."""
-    global hit_counter
     min_id = args.min
     max_id = args.max
     blacklist = set(args.blacklist)
     blacklist_duration = args.autoblacklist
-    hit_counter = 0
+    state = DiscoveryState()
 
     def is_valid_response(msg):
         """
@@ -208,17 +326,20 @@ def xcp_arbitration_id_discovery(args):
         print("Starting XCP discovery")
 
         def response_analyser_wrapper(arb_id):
-            print("\rSending XCP connect to 0x{0:04x}".format(arb_id), end="")
-            stdout.flush()
+            # Throttle progress output, since the scan may cover a large number of arbitration IDs
+            now = time.monotonic()
+            if now - state.last_progress_time >= PROGRESS_INTERVAL or arb_id == max_id:
+                state.last_progress_time = now
+                stdout.write("\rSending XCP connect to 0x{0:04x}".format(arb_id))
+                stdout.flush()
 
             def response_analyser(msg):
-                global hit_counter
                 # Ignore blacklisted arbitration IDs
                 if msg.arbitration_id in blacklist:
                     return
                 # Handle positive response
                 if msg.data[0] == 0xff and any(msg.data[1:]):
-                    hit_counter += 1
+                    state.hit_counter += 1
                     decode_connect_response(msg)
                     print("Found XCP at arb ID 0x{0:04x}, reply at 0x{1:04x}".format(arb_id, msg.arbitration_id))
                     print("#" * 20)
@@ -232,23 +353,29 @@ def xcp_arbitration_id_discovery(args):
             return response_analyser
 
         def discovery_end(s):
-            print("\r{0}: Found {1} possible matches.".format(s, hit_counter))
+            print("\r{0}: Found {1} possible matches.".format(s, state.hit_counter))
+
+        def is_xcp_response(msg):
+            return msg.arbitration_id not in blacklist and is_valid_response(msg)
 
         can_wrap.bruteforce_arbitration_id([0xff], response_analyser_wrapper,
-                                           min_id=min_id, max_id=max_id, callback_end=discovery_end)
+                                           min_id=min_id, max_id=max_id, callback_end=discovery_end,
+                                           response_filter=is_xcp_response)
 
 
 def xcp_command_discovery(args):
     """Attempts to call all XCP commands and lists which ones are supported."""
-    global connect_reply, command_reply
     send_arb_id = args.src
     rcv_arb_id = args.dst
-    connect_message = [0xff, 0, 0, 0, 0, 0, 0, 0]
+    # Command message, where the first byte is set to the current command code
+    cmd_msg = bytearray(8)
+    # Set by the callback handlers when a reply is received
+    connect_reply = threading.Event()
+    command_reply = threading.Event()
 
     def connect_callback_handler(msg):
-        global connect_reply
         if msg.arbitration_id == rcv_arb_id:
-            connect_reply = True
+            connect_reply.set()
 
     print("XCP command discovery\n")
     print("COMMAND{0}SUPPORTED".format(" " * 17))
@@ -257,32 +384,25 @@ def xcp_command_discovery(args):
         # Bruteforce against list of commands (excluding connect)
         for cmd_code, cmd_desc in XCP_COMMAND_CODES[1:]:
             # Connect
-            connect_reply = False
-            can_wrap.send_single_message_with_callback(connect_message, connect_callback_handler)
-            connect_timestamp = datetime.now()
-            while not connect_reply and datetime.now() - connect_timestamp < timedelta(seconds=3):
-                pass
-            if not connect_reply:
+            connect_reply.clear()
+            can_wrap.send_single_message_with_callback(XCP_CONNECT_MESSAGE, connect_callback_handler)
+            if not connect_reply.wait(REPLY_TIMEOUT):
                 print("ERROR: Connect timeout")
                 exit()
 
             # Build message for current command
-            cmd_msg = [cmd_code, 0, 0, 0, 0, 0, 0, 0]
+            cmd_msg[0] = cmd_code
 
             # Callback handler for current command
             def callback_handler(msg):
-                global command_reply
                 if msg.arbitration_id == rcv_arb_id:
                     print("{0:<23} {1}".format(cmd_desc, msg.data[0] != 0xfe))
-                    command_reply = True
+                    command_reply.set()
 
-            command_reply = False
+            command_reply.clear()
             # Send, wait for reply, clear listeners and move on
             can_wrap.send_single_message_with_callback(cmd_msg, callback=callback_handler)
-            command_timestamp = datetime.now()
-            while not command_reply and datetime.now() - command_timestamp < timedelta(seconds=3):
-                pass
-            if not command_reply:
+            if not command_reply.wait(REPLY_TIMEOUT):
                 print("ERROR: Command timeout")
                 exit()
             can_wrap.clear_listeners()
@@ -292,12 +412,15 @@ def xcp_command_discovery(args):
 def xcp_get_basic_information(args):
     send_arb_id = args.src
     rcv_arb_id = args.dst
+    # Set when the reply to the current probe has been handled
+    probe_done = threading.Event()
 
-    def callback_wrapper(callback):
+    def callback_wrapper(callback, final=True):
         """
         Adds handling of uninteresting or error messages to a callback function.
 
         :param callback: The callback function to run on successful messages
+        :param final: Whether a successful message completes the current probe
         :return: A callback function with extended message handling
         """
 
@@ -305,48 +428,72 @@ def xcp_get_basic_information(args):
             if msg.arbitration_id != rcv_arb_id:
                 return
             if msg.data[0] == 0xfe:
+                probe_done.set()
                 return
             if msg.data[0] == 0xff:
                 callback(msg)
+                if final:
+                    probe_done.set()
             else:
                 print("Unexpected reply:\n{0}\n".format(msg))
 
         return c
 
-    class ProbeMessage:
-        """Wrapper class for probe messages"""
+    # Number of GetId bytes left to receive for the current probe
+    get_id_bytes_left = 0
+    # Byte order of the slave, updated from the connect reply
+    byte_order = "<"
 
-        def __init__(self, message_data, callback):
-            self.message_data = message_data
-            self.callback = callback_wrapper(callback)
+    def handle_connect_reply(msg):
+        nonlocal byte_order
+        byte_order = get_byte_order(msg.data[2])
+        decode_connect_response(msg)
 
-        def __str__(self):
-            return "[{0}]".format(list_to_hex_str(self.message_data, ", "))
+    def handle_get_status_reply(msg):
+        decode_get_status_response(msg, byte_order)
 
-    # Callback handler for GetId messages
+    # Callback handler for GetId messages - longer texts arrive as several UPLOAD replies (block mode)
     def print_msg_as_text(msg):
-        print(list_to_hex_str(msg.data[1:], ""))
+        nonlocal get_id_bytes_left
+        text = msg.data[1:1 + get_id_bytes_left]
+        print(list_to_hex_str(text, ""))
+        get_id_bytes_left -= len(text)
+        if get_id_bytes_left < 1:
+            probe_done.set()
+
+    # UPLOAD message for GetId text, where the second byte is set to the text length
+    get_id_upload_message = bytearray([0xf5, 0])
+    print_msg_callback = callback_wrapper(print_msg_as_text, final=False)
 
     def handle_get_id_reply(msg):
-        can_wrap.send_single_message_with_callback([0xf5, msg.data[4]], callback_wrapper(print_msg_as_text))
-
-    # Define probe messages
-    probe_msgs = [ProbeMessage([0xff], decode_connect_response),  # Connect
-                  ProbeMessage([0xfb], decode_get_comm_mode_info_response),  # GetCommMode
-                  ProbeMessage([0xfd], decode_get_status_response),  # GetStatus
-                  ProbeMessage([0xfa, 0x00], handle_get_id_reply),  # GetId ASCII text
-                  ProbeMessage([0xfa, 0x01], handle_get_id_reply),  # GetId ASAM-MC2 filename w/o path/ext
-                  ProbeMessage([0xfa, 0x02], handle_get_id_reply),  # GetId ASAM-MC2 filename with path/ext
-                  ProbeMessage([0xfa, 0x03], handle_get_id_reply),  # GetId ASAM-MC2 URL
-                  ProbeMessage([0xfa, 0x04], handle_get_id_reply)]  # GetId ASAM-MC2 fileToUpload
+        nonlocal get_id_bytes_left
+        get_id_bytes_left = msg.data[4]
+        if get_id_bytes_left == 0:
+            probe_done.set()
+            return
+        get_id_upload_message[1] = get_id_bytes_left
+        can_wrap.send_single_message_with_callback(get_id_upload_message, print_msg_callback)
+
+    # Define probe messages (GetId probes are completed once all bytes of the following upload are received)
+    get_id_callback = callback_wrapper(handle_get_id_reply, final=False)
+    probe_msgs = [ProbeMessage(bytearray([0xff]), callback_wrapper(handle_connect_reply)),  # Connect
+                  ProbeMessage(bytearray([0xfb]), callback_wrapper(decode_get_comm_mode_info_response)),  # GetCommMode
+                  ProbeMessage(bytearray([0xfd]), callback_wrapper(handle_get_status_reply)),  # GetStatus
+                  ProbeMessage(bytearray([0xfa, 0x00]), get_id_callback),  # GetId ASCII text
+                  ProbeMessage(bytearray([0xfa, 0x01]), get_id_callback),  # GetId ASAM-MC2 filename w/o path/ext
+                  ProbeMessage(bytearray([0xfa, 0x02]), get_id_callback),  # GetId ASAM-MC2 filename with path/ext
+                  ProbeMessage(bytearray([0xfa, 0x03]), get_id_callback),  # GetId ASAM-MC2 URL
+                  ProbeMessage(bytearray([0xfa, 0x04]), get_id_callback)]  # GetId ASAM-MC2 fileToUpload
 
     # Initiate probing
     with CanActions(arb_id=send_arb_id) as can_wrap:
         print("Probing for XCP info")
         for probe in probe_msgs:
-            print("Sending probe message: {0}".format(probe))
+            print("Sending probe message: [{0}]".format(list_to_hex_str(probe.message_data, ", ")))
+            probe_done.clear()
             can_wrap.send_single_message_with_callback(probe.message_data, probe.callback)
-            time.sleep(2)
+            # Move on to the next probe as soon as the reply has been handled
+            probe_done.wait(PROBE_TIMEOUT)
         print("Probing finished")
 
 
@@ -361,120 +508,103 @@ def xcp_memory_dump(args):
     start_address = args.start
     length = args.length
     dump_file = args.f
-    # TODO Implement support for larger segments against ECUs which support this (e.g. 0xfc for test board)
-    max_segment_size = 0x7
 
-    global byte_counter, bytes_left, dump_complete, segment_counter, timeout_start
-    # Timeout timer
-    dump_complete = False
-    # Counters for data length
-    byte_counter = 0
-    segment_counter = 0
+    state = DumpState(length)
+    # Set on every upload reply, to reset the idle timeout
+    upload_reply = threading.Event()
+
+    # UPLOAD message, where the second byte is set to the segment size
+    upload_message = bytearray([0xf5, 0])
 
+    def request_upload():
+        upload_message[1] = min(state.max_segment_size, state.bytes_left)
+        can_wrap.send_single_message_with_callback(upload_message, handle_upload_reply)
+
+    @xcp_reply(rcv_arb_id)
     def handle_upload_reply(msg):
-        global byte_counter, bytes_left, dump_complete, timeout_start, segment_counter
-        if msg.arbitration_id != rcv_arb_id:
-            return
-        if msg.data[0] == 0xfe:
-            decode_xcp_error(msg)
-            return
-        if msg.data[0] == 0xff:
-            # Reset timeout timer
-            timeout_start = datetime.now()
-            # Calculate end index of data to handle
-            end_index = min(8, bytes_left + 1)
+        # Calculate end index of data to handle
+        end_index = min(len(msg.data), state.bytes_left + 1)
 
+        chunk = bytearray(msg.data[1:end_index])
+        if dump_file:
+            outfile.write(chunk)
+        else:
+            print(chunk.hex(" "))
+        # Update counters with the number of data bytes handled
+        state.byte_counter += end_index - 1
+        state.bytes_left -= end_index - 1
+        if state.bytes_left < 1:
             if dump_file:
-                with open(dump_file, "ab") as outfile:
-                    outfile.write(bytearray(msg.data[1:end_index]))
-            else:
-                print(list_to_hex_str(msg.data[1:end_index], " "))
-            # Update counters
-            byte_counter += max_segment_size
-            bytes_left -= max_segment_size
-            if bytes_left < 1:
-                if dump_file:
-                    print("\rDumping segment {0} ({1} b, 0 b left)".format(segment_counter, length), end="")
-                print("Dump complete!")
-                dump_complete = True
-            elif byte_counter > max_segment_size - 1:
-                # Dump another segment
-                segment_counter += 1
-                if dump_file:
-                    # Print progress
+                print("\rDumping segment {0} ({1} b, 0 b left)".format(state.segment_counter, length), end="")
+            print("Dump complete!")
+            stdout.flush()
+            state.dump_complete = True
+        elif state.byte_counter > state.max_segment_size - 1:
+            # Dump another segment
+            state.segment_counter += 1
+            if dump_file:
+                # Print progress, throttled to avoid a write and flush for every segment
+                now = time.monotonic()
+                if now - state.last_progress_time >= PROGRESS_INTERVAL:
+                    state.last_progress_time = now
                     print("\rDumping segment {0} ({1} b, {2} b left)".format(
-                        segment_counter, ((segment_counter + 1) * max_segment_size + byte_counter), bytes_left), end="")
+                        state.segment_counter, length - state.bytes_left, state.bytes_left), end="")
                     stdout.flush()
 
-                byte_counter = 0
-                can_wrap.send_single_message_with_callback([0xf5, min(max_segment_size, bytes_left)],
-                                                           handle_upload_reply)
+            state.byte_counter = 0
+            request_upload()
+        # Reset idle timeout (after state.dump_complete has been updated)
+        upload_reply.set()
 
+    @xcp_reply(rcv_arb_id)
     def handle_set_mta_reply(msg):
-        if msg.arbitration_id != rcv_arb_id:
-            return
-        if msg.data[0] == 0xfe:
-            decode_xcp_error(msg)
-            return
-        if msg.data[0] == 0xff:
-            print("Set MTA acked")
-            print("Dumping data:")
-            # Initiate dumping
-            if dump_file:
-                print("\rDumping segment 0", end="")
-            can_wrap.send_single_message_with_callback([0xf5, min(max_segment_size, bytes_left)], handle_upload_reply)
-        else:
-            print("Unexpected reply: {0}\n".format(msg))
-
+        print("Set MTA acked")
+        print("Dumping data:")
+        # Initiate dumping
+        if dump_file:
+            print("\rDumping segment 0", end="")
+        request_upload()
+
+    @xcp_reply(rcv_arb_id)
     def handle_connect_reply(msg):
-        if msg.arbitration_id != rcv_arb_id:
-            return
-        if msg.data[0] == 0xfe:
-            decode_xcp_error(msg)
-            return
-        if msg.data[0] == 0xff:
-            print("Connected: Using", end=" ")
-            # Check connect reply to see whether to reverse byte order for MTA
-            msb_format = msg.data[2] & 1
-            if msb_format:
-                print("Motorola format (MSB lower)")
-            else:
-                print("Intel format (LSB lower)")
-                r.reverse()
-            can_wrap.send_single_message_with_callback(
-                [0xf6, 0x00, 0x00, 0x00, r[0], r[1], r[2], r[3]],
-                handle_set_mta_reply)
+        print("Connected: Using", end=" ")
+        # Check connect reply to see which byte order to use for MTA
+        byte_order = get_byte_order(msg.data[2])
+        if byte_order == ">":
+            print("Motorola format (MSB lower)")
         else:
-            print("Unexpected connect reply: {0}\n".format(msg))
-
-    # Calculate address bytes (4 bytes, least significant first)
-    r = []
-    n = start_address
-    bytes_left = length
-    # Calculate start address (r is automatically reversed after connect if needed)
-    n &= 0xffffffff
-    for i in range(4):
-        r.append(n & 0xff)
-        n >>= 8
-    # Make sure dump_file can be opened if specified (clearing it if it already exists)
+            print("Intel format (LSB lower)")
+        # Request as many bytes per UPLOAD as fit in a single reply (MAX_CTO minus the PID byte)
+        max_cto = msg.data[3]
+        if max_cto > 1:
+            state.max_segment_size = max_cto - 1
+        address_bytes = bytearray(struct.pack(byte_order + "I", start_address & 0xffffffff))
+        can_wrap.send_single_message_with_callback(
+            [0xf6, 0x00, 0x00, 0x00] + list(address_bytes),
+            handle_set_mta_reply)
+
+    # Open dump_file once if specified (clearing it if it already exists)
+    outfile = None
     if dump_file:
         try:
-            with open(dump_file, "w") as _:
-                pass
+            outfile = open(dump_file, "wb")
         except IOError as e:
             print("Error when opening dump file:\n\n{0}".format(e))
             return
-    # Initialize
-    with CanActions(arb_id=send_arb_id) as can_wrap:
-        print("Attempting XCP memory dump")
-        # Connect and prepare for dump
-        can_wrap.send_single_message_with_callback([0xff, 0, 0, 0, 0, 0, 0, 0], handle_connect_reply)
-        # Idle timeout handling
-        timeout_start = datetime.now()
-        while not dump_complete and datetime.now() - timeout_start < timedelta(seconds=3):
-            pass
-        if not dump_complete:
-            print("\nERROR: Dump ended due to idle timeout")
+    try:
+        # Initialize
+        with CanActions(arb_id=send_arb_id) as can_wrap:
+            print("Attempting XCP memory dump")
+            # Connect and prepare for dump
+            can_wrap.send_single_message_with_callback(XCP_CONNECT_MESSAGE, handle_connect_reply)
+            # Idle timeout handling - wait until the dump completes or no reply is received within REPLY_TIMEOUT
+            while not state.dump_complete and upload_reply.wait(REPLY_TIMEOUT):
+                upload_reply.clear()
+            if not state.dump_complete:
+                print("\nERROR: Dump ended due to idle timeout")
+    finally:
+        if outfile is not None:
+            outfile.close()
 
 
 def parse_args(args):
@@ -0,0 +1,59 @@
+from caringcaribou.modules import fuzzer
+import unittest
+
+
+class FuzzerDataTestCase(unittest.TestCase):
+
+    def test_nibbles_to_bytes(self):
+        result = fuzzer.nibbles_to_bytes([0x2, 0x1, 0xF, 0xA, 0x3, 0xC])
+        self.assertListEqual(list(result), [0x21, 0xFA, 0x3C])
+
+    def test_apply_fuzzed_data(self):
+        result = fuzzer.apply_fuzzed_data([0x2, 0x4, 0xA, 0xB], [0x5, 0xF], [False, True, True, False])
+        self.assertListEqual(list(result), [0x25, 0xFB])
+
+    def test_apply_fuzzed_data_no_fuzzed_nibbles(self):
+        result = fuzzer.apply_fuzzed_data([0x1, 0x2, 0x3, 0x4], [], [False, False, False, False])
+        self.assertListEqual(list(result), [0x12, 0x34])
+
+    def test_apply_fuzzed_data_all_fuzzed_nibbles(self):
+        result = fuzzer.apply_fuzzed_data([0x0, 0x0, 0x0, 0x0], [0xD, 0xE, 0xA, 0xD], [True, True, True, True])
+        self.assertListEqual(list(result), [0xDE, 0xAD])
+
+    def test_parse_directive(self):
+        arb_id, data = fuzzer.parse_directive("7A0#C0FFEE")
+        self.assertEqual(arb_id, 0x7A0)
+        self.assertListEqual(list(data), [0xC0, 0xFF, 0xEE])
+
+    def test_parse_directive_missing_separator(self):
+        with self.assertRaises(ValueError):
+            fuzzer.parse_directive("7A0C0FFEE")
+
+    def test_apply_fuzzed_data_unknown_initial_nibbles(self):
+        # Fuzzed indices may lack initial values, e.g. when parsed by parse_hex_and_dot_indices
+        initial_data, bitmap = fuzzer.parse_hex_and_dot_indices("1.3.")
+        result = fuzzer.apply_fuzzed_data(initial_data, [0xA, 0xB], bitmap)
+        self.assertListEqual(list(result), [0x1A, 0x3B])
+
+    def test_split_lists(self):
+        sub_lists = list(fuzzer.split_lists(list(range(7)), 3))
+        self.assertListEqual(sub_lists, [[0, 1], [2, 3], [4, 5, 6]])
+
+    def test_split_lists_skips_empty_sub_lists(self):
+        sub_lists = list(fuzzer.split_lists([1, 2], 3))
+        self.assertListEqual(sub_lists, [[1], [2]])
+
+    def test_random_message_generator_limits(self):
+        messages = fuzzer.random_message_generator(0x100, 0x10F, 2, 5, batch_size=16)
+        for _ in range(100):
+            arb_id, data = next(messages)
+            self.assertTrue(0x100 <= arb_id <= 0x10F)
+            self.assertTrue(2 <= len(data) <= 5)
+
+    def test_fuzzed_data_applier(self):
+        initial_data, bitmap = fuzzer.parse_hex_and_dot_indices("1.3.")
+        apply_fuzzed_nibbles = fuzzer.fuzzed_data_applier(initial_data, bitmap)
+        self.assertListEqual(list(apply_fuzzed_nibbles([0xA, 0xB])), [0x1A, 0x3B])
+        self.assertListEqual(list(apply_fuzzed_nibbles([0xF, 0x7])), [0x1F, 0x37])
+        # Fuzzed indices without a fuzzed nibble are zero
+        self.assertListEqual(list(apply_fuzzed_nibbles([0xC])), [0x1C, 0x30])
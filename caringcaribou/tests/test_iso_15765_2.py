@@ -61,3 +61,24 @@ class IsoTpTestCase(unittest.TestCase):
             max_allowed_length = iso15765_2.IsoTp.MAX_MESSAGE_LENGTH
             too_long_message = [0x0] * (max_allowed_length + 1)
             self.tp.send_request(too_long_message)
+
+
+class IsoTpFramesTestCase(unittest.TestCase):
+
+    def test_get_frames_single_frame(self):
+        frames = iso15765_2.IsoTp.get_frames_from_message([0x01, 0x02, 0x03])
+        self.assertEqual([list(frame) for frame in frames], [[0x03, 0x01, 0x02, 0x03, 0x00, 0x00, 0x00, 0x00]])
+
+    def test_get_frames_multi_frame_padding(self):
+        frames = iso15765_2.IsoTp.get_frames_from_message(list(range(1, 15)), padding_value=0xAA)
+        expected_frames = [[0x10, 0x0E, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06],
+                           [0x21, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D],
+                           [0x22, 0x0E, 0xAA, 0xAA, 0xAA, 0xAA, 0xAA, 0xAA]]
+        self.assertEqual([list(frame) for frame in frames], expected_frames)
+
+    def test_get_frames_multi_frame_no_padding(self):
+        frames = iso15765_2.IsoTp.get_frames_from_message(list(range(1, 15)), padding_value=None)
+        expected_frames = [[0x10, 0x0E, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06],
+                           [0x21, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x0C, 0x0D],
+                           [0x22, 0x0E]]
+        self.assertEqual([list(frame) for frame in frames], expected_frames)
@@ -1,44 +1,96 @@
 from caringcaribou.modules import send
+import os
+import tempfile
 import unittest
 
 
 class SendFileParserTestCase(unittest.TestCase):
 
-    RESULT_DATA_C0FFEE = [0xc0, 0xff, 0xee]
-    RESULT_DATA_DEAD_CAFE = [0xde, 0xad, 0xca, 0xfe]
+    RESULT_DATA_C0FFEE = bytes([0xc0, 0xff, 0xee])
+    RESULT_DATA_DEAD_CAFE = bytes([0xde, 0xad, 0xca, 0xfe])
 
     def test_parse_candump_line(self):
         line = "(1499197954.029156) can0 123#c0ffee"
         message, timestamp = send.parse_candump_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(message.data, self.RESULT_DATA_C0FFEE)
 
     def test_parse_pythoncan_line_v_20(self):
         # Parse message format for python-can 2.0
         line = "Timestamp:        0.000000        ID: 017a    000    DLC: 3    c0 ff ee"
         message, timestamp = send.parse_pythoncan_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(message.data, self.RESULT_DATA_C0FFEE)
 
     def test_parse_pythoncan_line_v_21(self):
         # Parse message format for python-can 2.1
         line = "Timestamp:        0.000000        ID: 0000    S          DLC: 3    c0 ff ee"
         message, timestamp = send.parse_pythoncan_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(message.data, self.RESULT_DATA_C0FFEE)
 
     def test_parse_pythoncan_line_v_21_flags(self):
         # Parse message format for python-can 2.1 with flags
         line = "Timestamp:        0.000000    ID: 00000000    X E R      DLC: 4    de ad ca fe"
         message, timestamp = send.parse_pythoncan_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_DEAD_CAFE)
+        self.assertEqual(message.data, self.RESULT_DATA_DEAD_CAFE)
 
     def test_parse_pythoncan_line_v_30_channel(self):
         # Parse message format for python-can 3.0 with channel
         line = "Timestamp:        0.000000    ID: 00000000    X                DLC:  3    c0 ff ee " \
                "                   Channel: vcan0"
         message, timestamp = send.parse_pythoncan_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(message.data, self.RESULT_DATA_C0FFEE)
 
     def test_parse_pythoncan_line_v_30_flags(self):
         # Parse message format for python-can 3.0 with flags
         line = "Timestamp:        0.000000    ID: 00000000    X   R            DLC:  4    de ad ca fe"
         message, timestamp = send.parse_pythoncan_line(line, None, None)
-        self.assertListEqual(message.data, self.RESULT_DATA_DEAD_CAFE)
+        self.assertEqual(message.data, self.RESULT_DATA_DEAD_CAFE)
+
+    def test_parse_messages(self):
+        messages = send.parse_messages(["123#c0.ff.ee", "0x7a0#0x12.0x34", "0x7a0#012"], 0.0, False)
+        self.assertEqual(messages[0].data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(messages[1].data, bytes([0x12, 0x34]))
+        self.assertEqual(messages[2].data, bytes([0x12]))
+
+    def test_parse_messages_invalid_byte_value(self):
+        with self.assertRaises(SystemExit):
+            send.parse_messages(["0x7a0#112233445566778899AABB"], 0.0, False)
+
+    def test_parse_file_candump(self):
+        contents = b"# Comment\n" \
+                   b"(1499197954.029156) can0 123#c0ffee\n" \
+                   b"\n" \
+                   b"(1499197954.529156) can0 1FFFFFFF#deadcafe\n"
+        messages = self._parse_file_contents(contents)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(messages[1].data, self.RESULT_DATA_DEAD_CAFE)
+        self.assertAlmostEqual(messages[1].delay, 0.5)
+        self.assertTrue(messages[1].is_extended)
+
+    def test_parse_file_candump_line_by_line_fallback(self):
+        # Remote frames are not handled by the single pass parser
+        contents = b"(1499197954.029156) can0 123#c0ffee\n" \
+                   b"(1499197954.279156) can0 124#R\n" \
+                   b"(1499197954.529156) can0 125#deadcafe\n"
+        messages = self._parse_file_contents(contents)
+        self.assertEqual(len(messages), 3)
+        self.assertAlmostEqual(messages[1].delay, 0.25)
+        self.assertAlmostEqual(messages[2].delay, 0.25)
+        self.assertEqual(messages[2].data, self.RESULT_DATA_DEAD_CAFE)
+
+    def test_parse_file_pythoncan(self):
+        contents = b"Timestamp:        0.000000    ID: 00000123    S                DLC:  3    c0 ff ee\n" \
+                   b"Timestamp:        0.500000    ID: 00000124    S                DLC:  4    de ad ca fe\n"
+        messages = self._parse_file_contents(contents)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0].data, self.RESULT_DATA_C0FFEE)
+        self.assertEqual(messages[1].data, self.RESULT_DATA_DEAD_CAFE)
+        self.assertAlmostEqual(messages[1].delay, 0.5)
+
+    def _parse_file_contents(self, contents):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(contents)
+        try:
+            return send.parse_file(f.name, None)
+        finally:
+            os.remove(f.name)
@@ -0,0 +1,28 @@
+from caringcaribou.modules import xcp
+import unittest
+
+
+class XcpDecodeTestCase(unittest.TestCase):
+
+    # Bytes per address for each value of the ADDRESS_GRANULARITY bits
+    ADDRESS_GRANULARITIES = [1, 2, 4, 8]
+
+    def test_address_granularity(self):
+        for granularity_bits, expected in enumerate(self.ADDRESS_GRANULARITIES):
+            comm_mode_basic = granularity_bits << 1
+            self.assertEqual(xcp.get_address_granularity(comm_mode_basic), expected)
+
+    def test_address_granularity_ignores_other_bits(self):
+        # BYTE_ORDER, SLAVE_BLOCK_MODE and OPTIONAL set, granularity bits 0b10
+        comm_mode_basic = 0xc5
+        self.assertEqual(xcp.get_address_granularity(comm_mode_basic), 4)
+
+    def test_session_configuration_id_intel(self):
+        data = [0xff, 0x00, 0x00, 0x00, 0x34, 0x12]
+        byte_order = xcp.get_byte_order(0x00)
+        self.assertEqual(xcp.get_session_configuration_id(data, byte_order), 0x1234)
+
+    def test_session_configuration_id_motorola(self):
+        data = [0xff, 0x00, 0x00, 0x00, 0x12, 0x34]
+        byte_order = xcp.get_byte_order(0x01)
+        self.assertEqual(xcp.get_session_configuration_id(data, byte_order), 0x1234)
@@ -1,7 +1,9 @@
 from __future__ import print_function
 from caringcaribou.utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED, ARBITRATION_ID_MIN, BYTE_MAX, BYTE_MIN
+from itertools import product
 from sys import stdout, version_info
 import can
+import threading
 import time
 
 # Handle large ranges efficiently in both python 2 and 3
@@ -9,9 +11,15 @@ if version_info[0] == 2:
     range = xrange
 
 
+# Default time in seconds to wait for responses to each message in bruteforce_arbitration_id and bruteforce_data
 MESSAGE_DELAY = 0.1
-DELAY_STEP = 0.02
+# Number of arbitration IDs to probe per response delay when bruteforcing with a response filter
+BRUTEFORCE_BATCH_SIZE = 8
+# Default time in seconds to wait for responses to each message in bruteforce_data_new
+RESPONSE_DELAY = 0.2
 NOTIFIER_STOP_DURATION = 0.5
+# Interval in seconds between status line updates in auto_blacklist
+AUTO_BLACKLIST_STATUS_INTERVAL = 0.1
 
 # Global CAN interface setting, which can be set through the -i flag to cc.py
 # The value None corresponds to the default CAN interface (typically can0)
@@ -40,27 +48,41 @@ def auto_blacklist(bus, duration, classifier_function, print_results):
     if print_results:
         print("Scanning for arbitration IDs to blacklist")
     blacklist = set()
-    start_time = time.time()
-    end_time = start_time + duration
-    while time.time() < end_time:
-        if print_results:
-            time_left = end_time - time.time()
-            num_matches = len(blacklist)
-            print("\r{0:> 5.1f} seconds left, {1} found".format(time_left, num_matches), end="")
-            stdout.flush()
-        # Receive message
-        msg = bus.recv(0.1)
-        if msg is None:
-            continue
-        # Classify
-        if classifier_function(msg):
-            # Add to blacklist
-            blacklist.add(msg.arbitration_id)
+    status_format = "\r{0:> 5.1f} seconds left, {1} found".format
+    last_status = None
+    # Receive in a notifier thread and handle buffered messages in bulk between status updates
+    reader = can.BufferedReader()
+    notifier = can.Notifier(bus, [reader], timeout=AUTO_BLACKLIST_STATUS_INTERVAL)
+    try:
+        end_time = time.monotonic() + duration
+        while True:
+            time_left = end_time - time.monotonic()
+            if time_left <= 0.0:
+                break
+            if print_results:
+                # Only repaint the status line when its contents have changed
+                status = status_format(time_left, len(blacklist))
+                if status != last_status:
+                    stdout.write(status)
+                    stdout.flush()
+                    last_status = status
+            # Handle buffered messages until the next status update is due
+            status_time = time.monotonic() + min(time_left, AUTO_BLACKLIST_STATUS_INTERVAL)
+            wait_time = status_time - time.monotonic()
+            while wait_time > 0.0:
+                msg = reader.get_message(wait_time)
+                # Classify
+                if msg is not None and classifier_function(msg):
+                    # Add to blacklist
+                    blacklist.add(msg.arbitration_id)
+                wait_time = status_time - time.monotonic()
+    finally:
+        notifier.stop(NOTIFIER_STOP_DURATION)
     if print_results:
         num_matches = len(blacklist)
         print("\r  0.0 seconds left, {0} found".format(num_matches), end="")
         if len(blacklist) > 0:
-            print("\n  Detected IDs: {0}".format(" ".join(sorted(list(map(hex, blacklist))))))
+            print("\n  Detected IDs: {0}".format(" ".join(map(hex, sorted(blacklist)))))
         else:
             print()
     return blacklist
@@ -77,7 +99,15 @@ class CanActions:
         """
         self.bus = can.Bus(context=DEFAULT_INTERFACE)
         self.arb_id = arb_id
-        self.bruteforce_running = False
+        # Set by bruteforce_stop to end a running bruteforce
+        self._stop_event = threading.Event()
+        # Listener for the value currently being bruteforced, called through _dispatch_message
+        self._current_listener = None
+        # Deadline for responses to the current bruteforce_data_new message, see current_delay
+        self._delay_end_time = 0.0
+        self._delay_changed = threading.Event()
+        # Message instance reused for every frame sent by the bruteforce loops
+        self._bruteforce_msg = can.Message(arbitration_id=0, data=bytearray(8))
         self.notifier = None
         if notifier_enabled:
             self.enable_notifier()
@@ -109,6 +139,43 @@ class CanActions:
         self.clear_listeners()
         self.add_listener(listener)
 
+    @property
+    def current_delay(self):
+        """
+        Remaining time in seconds that bruteforce_data_new waits for responses to the current message.
+
+        Listeners can set this to extend the wait (e.g. for pending or multi frame responses) or set it to 0.0
+        to move on to the next message immediately.
+        """
+        return max(0.0, self._delay_end_time - time.monotonic())
+
+    @current_delay.setter
+    def current_delay(self, delay):
+        self._delay_end_time = time.monotonic() + delay
+        self._delay_changed.set()
+
+    def _wait_for_current_delay(self):
+        while True:
+            # Clear before checking the deadline, so that a concurrent update always wakes up the wait
+            self._delay_changed.clear()
+            time_left = self._delay_end_time - time.monotonic()
+            if time_left <= 0.0 or self._stop_event.is_set():
+                return
+            self._delay_changed.wait(time_left)
+
+    def _dispatch_message(self, msg):
+        listener = self._current_listener
+        if listener is not None:
+            listener(msg)
+
+    def _start_dispatch(self):
+        self._current_listener = None
+        self.set_listener(self._dispatch_message)
+
+    def _stop_dispatch(self):
+        self.clear_listeners()
+        self._current_listener = None
+
     def send(self, data, arb_id=None, is_extended=None, is_error=False, is_remote=False):
         if len(data) > 8:
             raise IndexError("Invalid CAN message length: {0}".format(len(data)))
@@ -127,8 +194,81 @@ class CanActions:
                           is_remote_frame=is_remote)
         self.bus.send(msg)
 
+    def _bruteforce_payload(self, data):
+        if len(data) > 8:
+            raise IndexError("Invalid CAN message length: {0}".format(len(data)))
+        # Mutate a bytearray copy in place, which can.Message uses without converting it
+        return bytearray(data)
+
+    def _send_bruteforce(self, data, arb_id):
+        """
+        Sends 'data' to 'arb_id' by updating and resending a single can.Message instance.
+
+        Only meant to be called from the bruteforce loops - listeners running in the notifier thread
+        use send(), which creates a new message per call.
+
+        :param data: bytearray of at most 8 data bytes
+        :param arb_id: int arbitration ID
+        """
+        msg = self._bruteforce_msg
+        msg.arbitration_id = arb_id
+        msg.is_extended_id = arb_id > ARBITRATION_ID_MAX
+        msg.data = data
+        msg.dlc = len(data)
+        self.bus.send(msg)
+
+    def _send_bruteforce_standard(self, data, arb_id):
+        msg = self._bruteforce_msg
+        msg.arbitration_id = arb_id
+        msg.is_extended_id = False
+        msg.data = data
+        msg.dlc = len(data)
+        self.bus.send(msg)
+
+    def _send_bruteforce_extended(self, data, arb_id):
+        msg = self._bruteforce_msg
+        msg.arbitration_id = arb_id
+        msg.is_extended_id = True
+        msg.data = data
+        msg.dlc = len(data)
+        self.bus.send(msg)
+
+    def _bruteforce_sender(self, min_id, max_id):
+        """
+        Returns the bruteforce send function to use for arbitration IDs in the range 'min_id' to 'max_id',
+        skipping the per-frame extended ID check when all IDs share the same format.
+
+        :param min_id: int minimum arbitration ID
+        :param max_id: int maximum arbitration ID
+        :return: function taking data and an arbitration ID
+        """
+        if max_id <= ARBITRATION_ID_MAX:
+            return self._send_bruteforce_standard
+        if min_id > ARBITRATION_ID_MAX:
+            return self._send_bruteforce_extended
+        return self._send_bruteforce
+
     def bruteforce_arbitration_id(self, data, callback, min_id, max_id,
-                                  callback_end=None):
+                                  callback_end=None, response_filter=None, batch_size=BRUTEFORCE_BATCH_SIZE,
+                                  delay=MESSAGE_DELAY):
+        """
+        Sends 'data' to all arbitration IDs in the range 'min_id' to 'max_id' (inclusive), using the listener
+        returned by 'callback(arb_id)' for incoming messages during the 'delay' after each message.
+
+        If 'response_filter' is set, 'batch_size' IDs at a time are probed back-to-back and share a single
+        'delay'. Since a response does not reveal which of the IDs in a batch it belongs to, a batch where
+        'response_filter(msg)' is True for any incoming message is then probed again one ID at a time.
+
+        :param data: list of data bytes to send
+        :param callback: function which takes an arbitration ID and returns a listener for incoming messages
+        :param min_id: int minimum arbitration ID, or None for default
+        :param max_id: int maximum arbitration ID, or None for default
+        :param callback_end: function to call with a status str when the bruteforce is finished
+        :param response_filter: function which, when called upon a can.Message instance, returns a bool
+                                indicating whether it is a response to the bruteforced message
+        :param batch_size: int number of arbitration IDs per batch when 'response_filter' is set
+        :param delay: float number of seconds to wait for responses after each message (or batch)
+        """
         # Set limits
         if min_id is None:
             min_id = ARBITRATION_ID_MIN
@@ -143,67 +283,101 @@ class CanActions:
             if callback_end:
                 callback_end("Invalid range: min > max")
             return
+        if response_filter is None:
+            batch_size = 1
+        data = self._bruteforce_payload(data)
+        send_bruteforce = self._bruteforce_sender(min_id, max_id)
+        batch_responses = []
+
+        def batch_listener(msg):
+            if response_filter(msg):
+                batch_responses.append(msg)
+
         # Start bruteforce
-        self.bruteforce_running = True
-        for arb_id in range(min_id, max_id + 1):
-            self.notifier.listeners = [callback(arb_id)]
-            # Use standard addressing (11 bits arbitration ID) instead of extended (29 bits) when possible
-            extended = False
-            if arb_id > ARBITRATION_ID_MAX:
-                extended = True
-            msg = can.Message(arbitration_id=arb_id, data=data, is_extended_id=extended)
-            self.bus.send(msg)
-            time.sleep(MESSAGE_DELAY)
-            # Return if stopped by calling module
-            if not self.bruteforce_running:
-                self.clear_listeners()
-                return
+        self._stop_event.clear()
+        self._start_dispatch()
+        for batch_start in range(min_id, max_id + 1, batch_size):
+            batch_end = min(batch_start + batch_size, max_id + 1)
+            if batch_size > 1:
+                del batch_responses[:]
+                self._current_listener = batch_listener
+                for arb_id in range(batch_start, batch_end):
+                    # Listener is not used, but callback is still called for its progress output
+                    callback(arb_id)
+                    send_bruteforce(data, arb_id)
+                if self._stop_event.wait(delay):
+                    self._stop_dispatch()
+                    return
+                if len(batch_responses) == 0:
+                    continue
+            for arb_id in range(batch_start, batch_end):
+                self._current_listener = callback(arb_id)
+                send_bruteforce(data, arb_id)
+                # Return if stopped by calling module
+                if self._stop_event.wait(delay):
+                    self._stop_dispatch()
+                    return
         # Callback if bruteforce finished without being stopped
         if callback_end:
-            self.clear_listeners()
+            self._stop_dispatch()
             callback_end("Bruteforce of range 0x{0:x}-0x{1:x} completed".format(min_id, max_id))
 
     def bruteforce_data(self, data, bruteforce_index, callback, min_value=BYTE_MIN, max_value=BYTE_MAX,
-                        callback_end=None):
-        self.bruteforce_running = True
+                        callback_end=None, delay=MESSAGE_DELAY):
+        data = self._bruteforce_payload(data)
+        send_bruteforce = self._bruteforce_sender(self.arb_id, self.arb_id)
+        self._stop_event.clear()
+        self._start_dispatch()
         for value in range(min_value, max_value + 1):
-            self.notifier.listeners = [callback(value)]
+            self._current_listener = callback(value)
             data[bruteforce_index] = value
-            self.send(data)
-            time.sleep(MESSAGE_DELAY)
-            if not self.bruteforce_running:
-                self.notifier.listeners = []
+            send_bruteforce(data, self.arb_id)
+            if self._stop_event.wait(delay):
+                self._stop_dispatch()
                 return
         if callback_end:
-            self.notifier.listeners = []
+            self._stop_dispatch()
             callback_end()
 
     def bruteforce_data_new(self, data, bruteforce_indices, callback,
                             min_value=BYTE_MIN, max_value=BYTE_MAX,
                             callback_done=None):
-        def send(msg_data, idxs):
-            self.notifier.listeners = [callback(["{0:02x}".format(msg_data[a]) for a in idxs])]
-            self.send(msg_data)
-            self.current_delay = 0.2
-            while self.current_delay > 0.0:
-                time.sleep(DELAY_STEP)
-                self.current_delay -= DELAY_STEP
-            if not self.bruteforce_running:
-                self.notifier.listeners = []
-                return
+        """
+        Sends 'data' with all combinations of values in the range 'min_value' to 'max_value' (inclusive)
+        at 'bruteforce_indices', waiting current_delay seconds for responses after each message.
 
-        def bruteforce(idx):
-            if idx >= len(bruteforce_indices):
-                send(data, bruteforce_indices)
-                return
-            for i in range(min_value, max_value + 1):
-                data[bruteforce_indices[idx]] = i
-                bruteforce(idx + 1)
-
-        # Make sure that the data array is correctly initialized for the bruteforce
-        for idx_i in bruteforce_indices:
-            data[idx_i] = 0
-        bruteforce(0)
+        :param data: list of data bytes to send
+        :param bruteforce_indices: list of indices in 'data' to bruteforce
+        :param callback: function which takes the bruteforced values as bytes and returns a listener
+                         for incoming messages
+        :param min_value: int minimum value
+        :param max_value: int maximum value
+        :param callback_done: function to call with a status str when the bruteforce is finished
+        """
+        data = self._bruteforce_payload(data)
+        send_bruteforce = self._bruteforce_sender(self.arb_id, self.arb_id)
+        self._stop_event.clear()
+        self._start_dispatch()
+        # Iterate over all combinations of values, where the last index changes fastest. Only the last index
+        # is updated for each message, while the others are updated once per combination of their values
+        values = range(min_value, max_value + 1)
+        leading_indices = bruteforce_indices[:-1]
+        last_index = bruteforce_indices[-1]
+        combination = bytearray(len(bruteforce_indices))
+        for leading_values in product(values, repeat=len(leading_indices)):
+            for position, (idx, value) in enumerate(zip(leading_indices, leading_values)):
+                data[idx] = value
+                combination[position] = value
+            for value in values:
+                data[last_index] = value
+                combination[-1] = value
+                self._current_listener = callback(bytes(combination))
+                send_bruteforce(data, self.arb_id)
+                self.current_delay = RESPONSE_DELAY
+                self._wait_for_current_delay()
+                if self._stop_event.is_set():
+                    self._stop_dispatch()
+                    return
         if callback_done:
             callback_done("Scan finished")
 
@@ -212,4 +386,6 @@ class CanActions:
         self.send(data)
 
     def bruteforce_stop(self):
-        self.bruteforce_running = False
+        self._stop_event.set()
+        # Wake up bruteforce_data_new if it is waiting for responses
+        self._delay_changed.set()
@@ -1,3 +1,9 @@
+from binascii import unhexlify
+import time
+
+# Number of seconds before a deadline to stop sleeping and start polling the clock in wait_until
+BUSY_WAIT_WINDOW = 0.0003
+
 
 def parse_int_dec_or_hex(value):
     """Parses an integer on base 10 (decimal) or 16 (hex with "0x" prefix)
@@ -24,7 +30,22 @@ def str_to_int_list(s):
     :return: list of byte values representing 's'
     :rtype: [int]
     """
-    return [int(s[i * 2:i * 2 + 2], 16) for i in range(len(s) // 2)]
+    return list(hex_str_to_bytes(s))
+
+
+def hex_str_to_bytes(s):
+    """Converts a string representing CAN message data into bytes.
+
+    Example:
+    hex_str_to_bytes("0102c0ffee") -> bytes([0x01, 0x02, 0xc0, 0xff, 0xee])
+
+    :param s: string representation of hex data
+    :type s: str or bytes
+    :return: bytes representing 's'
+    :rtype: bytes
+    """
+    # Ignore a trailing odd character, which does not make up a full byte
+    return unhexlify(s[:len(s) - len(s) % 2])
 
 
 def int_from_byte_list(byte_values, start_index=0, length=None):
@@ -105,3 +126,48 @@ def msg_to_candump_format(msg):
     data = list_to_hex_str(msg.data, "")
     candump = output.format(msg.timestamp, msg.channel, msg.arbitration_id, data)
     return candump
+
+
+def periodic_counter(interval):
+    """Generator yielding 1, 2, 3, ... at a fixed cadence of one value every 'interval' seconds
+
+    The generator sleeps until the next slot is due. Slots which have already been missed
+    (e.g. due to a slow loop body) are skipped, rather than yielded in a burst to catch up.
+
+    Example:
+    for counter in periodic_counter(0.5):
+        send_message()
+
+    :param interval: seconds between each value
+    :type interval: float
+    :return: generator of int counter values, starting at 1
+    :rtype generator
+    """
+    counter = 1
+    next_time = time.monotonic()
+    while True:
+        yield counter
+        counter += 1
+        next_time += interval
+        sleep_time = next_time - time.monotonic()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        else:
+            next_time = time.monotonic()
+
+
+def wait_until(deadline):
+    """Waits until the monotonic clock reaches 'deadline'
+
+    Sleeping alone tends to overshoot short delays, so the last BUSY_WAIT_WINDOW seconds
+    are spent polling the clock instead.
+
+    :param deadline: time.monotonic() value to wait for
+    :type deadline: float
+    :return: None
+    """
+    time_left = deadline - time.monotonic()
+    if time_left > BUSY_WAIT_WINDOW:
+        time.sleep(time_left - BUSY_WAIT_WINDOW)
+    while time.monotonic() < deadline:
+        pass
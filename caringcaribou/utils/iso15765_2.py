@@ -1,7 +1,7 @@
 from caringcaribou.utils.can_actions import DEFAULT_INTERFACE
+from caringcaribou.utils.common import wait_until
 from caringcaribou.utils.constants import ARBITRATION_ID_MAX_EXTENDED, ARBITRATION_ID_MAX
 import can
-import datetime
 import time
 
 
@@ -29,6 +29,10 @@ class IsoTp:
     CF_FRAME_ID = 2
     FC_FRAME_ID = 3
 
+    # Flow control (FC) frames sent by indication(), without block size (BS) and separation time (STmin) limits
+    FC_CTS_FRAME = bytes([(FC_FRAME_ID << 4) | FC_FS_CTS, 0, 0, 0, 0, 0, 0, 0])
+    FC_OVFLW_FRAME = bytes([(FC_FRAME_ID << 4) | FC_FS_OVFLW, 0, 0, 0, 0, 0, 0, 0])
+
     N_BS_TIMEOUT = 1.5
 
     MAX_FRAME_LENGTH = 8
@@ -104,7 +108,7 @@ class IsoTp:
         if len(frame) >= self.SF_PCI_LENGTH:
             sf_dl = frame[0] & 0xF
             data = frame[1:]
-            return sf_dl, list(data)
+            return sf_dl, data
         else:
             return None, None
 
@@ -119,7 +123,7 @@ class IsoTp:
         if len(frame) >= self.FF_PCI_LENGTH:
             ff_dl = ((frame[0] & 0xF) << 8) | frame[1]
             data = frame[2:]
-            return ff_dl, list(data)
+            return ff_dl, data
         else:
             return None, None
 
@@ -134,7 +138,7 @@ class IsoTp:
         if len(frame) >= self.CF_PCI_LENGTH:
             sn = frame[0] & 0xF
             data = frame[1:]
-            return sn, list(data)
+            return sn, data
         else:
             return None, None
 
@@ -194,23 +198,22 @@ class IsoTp:
         :param first_frame_only: If True, return first frame only (simulating overflow behavior for multi-frame message)
         :return: A list of received data bytes if successful, None otherwise
         """
-        message = []
+        message = bytearray()
 
         if wait_window is None:
             wait_window = self.N_BS_TIMEOUT
-        start_time = datetime.datetime.now()
-        end_time = start_time + datetime.timedelta(seconds=wait_window)
+        end_time = time.monotonic() + wait_window
         sn = 0
         message_length = 0
 
         while True:
             # Timeout check
-            current_time = datetime.datetime.now()
-            if current_time >= end_time:
+            time_left = end_time - time.monotonic()
+            if time_left <= 0.0:
                 # Timeout
                 return None
             # Receive frame
-            msg = self.bus.recv(wait_window)
+            msg = self.bus.recv(time_left)
             if msg is not None:
                 if msg.arbitration_id == self.arb_id_request:
                     flow_control_arbitration_id = self.arb_id_response
@@ -227,7 +230,7 @@ class IsoTp:
                         dl, message = self.decode_sf(frame)
                         if trim_padding:
                             # Trim padding, in case the data exceeds single frame data length (SF_DL)
-                            message = message[:dl]
+                            del message[dl:]
                         break
                     elif frame_type == self.FF_FRAME_ID:
                         # First frame (FF) of a multi-frame message
@@ -235,30 +238,26 @@ class IsoTp:
                         if first_frame_only:
                             # This is a hack to make it possible to only retrieve the first frame of a multi-frame
                             # response, by telling the sender to stop sending data due to overflow
-                            ovflw_frame = self.encode_fc(self.FC_FS_OVFLW, 0, 0)
                             # Respond with overflow (OVFLW) message
-                            self.send_message(ovflw_frame, flow_control_arbitration_id)
+                            self.send_message(self.FC_OVFLW_FRAME, flow_control_arbitration_id)
                             # Return the first frame only
                             break
-                        fc_frame = self.encode_fc(self.FC_FS_CTS, 0, 0)
                         sn = 0
                         # Respond with flow control (FC) message
-                        self.send_message(fc_frame, flow_control_arbitration_id)
+                        self.send_message(self.FC_CTS_FRAME, flow_control_arbitration_id)
                     elif frame_type == self.CF_FRAME_ID:
-                        # Consecutive frame (CF)
-                        new_sn, data = self.decode_cf(frame)
-                        if (sn + 1) % 16 == new_sn:
+                        # Consecutive frame (CF) - decoded inline, since this is done for most frames of long messages
+                        new_sn = frame[0] & 0xF
+                        if ((sn + 1) & 0xF) == new_sn:
                             sn = new_sn
-                            message += data
+                            message += frame[1:]
                             if len(message) >= message_length:
                                 # Last frame received
                                 if trim_padding:
                                     # Trim padding of last frame, which may exceed first frame data length (FF_DL)
-                                    message = message[:message_length]
+                                    del message[message_length:]
                                 # Stop listening for more frames
                                 break
-                            else:
-                                pass
                     else:
                         # Invalid frame type
                         return None
@@ -268,7 +267,7 @@ class IsoTp:
         """
         Transmits 'frames' in order on the bus, according to ISO-15765-2
 
-        :param frames: List of frames (which are in turn lists of values) to send
+        :param frames: List of frames (which are in turn lists or bytearrays of values) to send
         :param arbitration_id: The arbitration ID used for sending
         :param arbitration_id_flow_control: The arbitration ID used for receiving flow control (FC)
         :return: None
@@ -288,6 +287,8 @@ class IsoTp:
             number_of_frames_left_to_send_in_block = 0
             frame_index += 1
             st_min = 0
+            # Consecutive frames (CF) are sent by updating the data of a single message
+            cf_msg = can.Message(arbitration_id=arbitration_id, is_extended_id=arbitration_id > ARBITRATION_ID_MAX)
             while number_of_frames_left_to_send > 0:
                 receiver_is_ready = False
                 while not receiver_is_ready:
@@ -323,14 +324,19 @@ class IsoTp:
                     else:
                         # Timeout - did not receive a CTS message in time
                         return None
+                separation_time = st_min / 1000
                 while number_of_frames_left_to_send_in_block > 0:
                     # Send more frames, until it is time to wait for flow control (FC) again
-                    self.send_message(frames[frame_index], arbitration_id)
+                    cf_msg.data = frames[frame_index]
+                    cf_msg.dlc = len(cf_msg.data)
+                    self.bus.send(cf_msg)
+                    send_time = time.monotonic()
                     frame_index += 1
                     number_of_frames_left_to_send_in_block -= 1
                     number_of_frames_left_to_send -= 1
-                    if number_of_frames_left_to_send_in_block > 0:
-                        time.sleep(st_min / 1000)
+                    # Only wait between frames when a separation time is requested
+                    if separation_time > 0 and number_of_frames_left_to_send_in_block > 0:
+                        wait_until(send_time + separation_time)
 
     @staticmethod
     def get_frames_from_message(message, padding_value=0x00):
@@ -338,7 +344,7 @@ class IsoTp:
         Returns a copy of 'message' split into frames,
         :param message: Message to split
         :param padding_value: Integer value used to pad messages, or None to disable padding (not part of ISO-15765-3)
-        :return: List of frames
+        :return: List of frames (bytearray)
         """
         if padding_value is None:
             padding_enabled = False
@@ -346,7 +352,7 @@ class IsoTp:
         else:
             padding_enabled = True
 
-        frame_list = []
+        message = bytes(message)
         message_length = len(message)
         if message_length > IsoTp.MAX_MESSAGE_LENGTH:
             error_msg = "Message too long for ISO-TP. Max allowed length is {0} bytes, received {1} bytes".format(
@@ -354,41 +360,34 @@ class IsoTp:
             raise ValueError(error_msg)
         if message_length <= IsoTp.MAX_SF_LENGTH:
             # Single frame (SF) message
+            frame = bytearray([SF_PCI_BYTES[message_length]]) + message
             if padding_enabled:
-                frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-            else:
-                frame = [padding_value] * (message_length + 1)
-            frame[0] = (IsoTp.SF_FRAME_ID << 4) | message_length
-            for i in range(0, message_length):
-                frame[1 + i] = message[i]
-            frame_list.append(frame)
-        else:
-            # Multiple frame message
-            bytes_left_to_copy = message_length
-            # Create first frame (FF)
-            frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-            frame[0] = (IsoTp.FF_FRAME_ID << 4) | (message_length >> 8)
-            frame[1] = message_length & 0xFF
-            for i in range(0, IsoTp.MAX_FF_LENGTH):
-                frame[2 + i] = message[i]
-            frame_list.append(frame)
-            # Create consecutive frames (CF)
-            bytes_copied = IsoTp.MAX_FF_LENGTH
-            bytes_left_to_copy -= bytes_copied
-            sn = 0
-            while bytes_left_to_copy > 0:
-                sn = (sn + 1) % 16
-                if not padding_enabled and bytes_left_to_copy < 7:
-                    # Skip padding on last CF
-                    frame = [padding_value] * (bytes_left_to_copy + 1)
-                else:
-                    frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-                frame[0] = (IsoTp.CF_FRAME_ID << 4) | sn
-                # Fill current CF
-                bytes_to_copy_to_current_cf = min(IsoTp.MAX_CF_LENGTH, bytes_left_to_copy)
-                for i in range(bytes_to_copy_to_current_cf):
-                    frame[1 + i] = message[bytes_copied]
-                    bytes_left_to_copy = bytes_left_to_copy - 1
-                    bytes_copied = bytes_copied + 1
-                frame_list.append(frame)
+                frame = frame.ljust(IsoTp.MAX_FRAME_LENGTH, bytearray([padding_value]))
+            return [frame]
+        # Multiple frame message - all frames are laid out after each other in a single padded buffer
+        cf_count = (message_length - IsoTp.MAX_FF_LENGTH + IsoTp.MAX_CF_LENGTH - 1) // IsoTp.MAX_CF_LENGTH
+        buffer = bytearray([padding_value]) * ((1 + cf_count) * IsoTp.MAX_FRAME_LENGTH)
+        # Create first frame (FF)
+        buffer[0] = (IsoTp.FF_FRAME_ID << 4) | (message_length >> 8)
+        buffer[1] = message_length & 0xFF
+        buffer[IsoTp.FF_PCI_LENGTH:IsoTp.MAX_FRAME_LENGTH] = message[:IsoTp.MAX_FF_LENGTH]
+        # Create consecutive frames (CF)
+        bytes_copied = IsoTp.MAX_FF_LENGTH
+        for cf_index in range(1, cf_count + 1):
+            frame_start = cf_index * IsoTp.MAX_FRAME_LENGTH
+            buffer[frame_start] = CF_PCI_BYTES[cf_index & 0xF]
+            cf_data = message[bytes_copied:bytes_copied + IsoTp.MAX_CF_LENGTH]
+            data_start = frame_start + IsoTp.CF_PCI_LENGTH
+            buffer[data_start:data_start + len(cf_data)] = cf_data
+            bytes_copied += IsoTp.MAX_CF_LENGTH
+        frame_list = [buffer[i:i + IsoTp.MAX_FRAME_LENGTH] for i in range(0, len(buffer), IsoTp.MAX_FRAME_LENGTH)]
+        if not padding_enabled:
+            # Skip padding on last CF
+            frame_list[-1] = frame_list[-1][:IsoTp.CF_PCI_LENGTH + len(cf_data)]
         return frame_list
+
+
+# Protocol control information (PCI) bytes of single frames, indexed by data length (SF_DL)
+SF_PCI_BYTES = tuple((IsoTp.SF_FRAME_ID << 4) | length for length in range(IsoTp.MAX_SF_LENGTH + 1))
+# PCI bytes of consecutive frames, indexed by sequence number (SN)
+CF_PCI_BYTES = tuple((IsoTp.CF_FRAME_ID << 4) | sn for sn in range(16))